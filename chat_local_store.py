@@ -36,12 +36,30 @@ class LocalStore:
         except Exception:
             return None
 
-    def recent(self, conv: str, limit: int = 100):
+    def reader(self):
+        # private connection for reads off the GUI thread; self.db is shared with the writers
+        return sqlite3.connect(self.path)
+
+    def last_id(self) -> int:
         try:
-            cur = self.db.execute(
-                "SELECT sender, ts, kind, text, self FROM messages WHERE conv=? ORDER BY id DESC LIMIT ?",
-                (conv, limit),
-            )
+            cur = self.db.execute("SELECT MAX(id) FROM messages")
+            row = cur.fetchone()
+            return int(row[0] or 0) if row else 0
+        except Exception:
+            return 0
+
+    def recent(self, conv: str, limit: int = 100, db=None, max_id: int = None):
+        try:
+            if max_id is not None:
+                cur = (db or self.db).execute(
+                    "SELECT sender, ts, kind, text, self FROM messages WHERE conv=? AND id<=? ORDER BY id DESC LIMIT ?",
+                    (conv, max_id, limit),
+                )
+            else:
+                cur = (db or self.db).execute(
+                    "SELECT sender, ts, kind, text, self FROM messages WHERE conv=? ORDER BY id DESC LIMIT ?",
+                    (conv, limit),
+                )
             rows = cur.fetchall()
             rows.reverse()
             return rows
@@ -10,6 +10,7 @@ import hmac
 import hashlib
 import json
 import sys
+import collections
 import uuid
 import cgi
 import io
@@ -517,7 +518,10 @@ except Exception:
 CONFIG_JSON = os.path.join(_data_dir, "config.json")
 SERVER_CONFIG = {"retention_days": 7, "latest_client_version": "1.0.4", "latest_client_download_url": "", "latest_client_release_notes": "", "latest_client_download_file_path": ""}
 ADMIN_PASSWORD = "123!@#qwe"
-ADMIN_SESSIONS = set()
+# insertion-ordered so the oldest logins fall off once the cap is reached
+ADMIN_SESSIONS = collections.OrderedDict()
+ADMIN_SESSIONS_MAX = 64
+_admin_sessions_lock = threading.Lock()
 USERS_JSON = os.path.join(_data_dir, "users.json")
 REGISTERED_USERS = set()
 
@@ -555,6 +559,12 @@ db.execute(
     "CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, conv TEXT, sender TEXT, ts INTEGER, text TEXT)"
 )
 db.commit()
+def _add_admin_session(token: str):
+    with _admin_sessions_lock:
+        ADMIN_SESSIONS[token] = None
+        while len(ADMIN_SESSIONS) > ADMIN_SESSIONS_MAX:
+            ADMIN_SESSIONS.popitem(last=False)
+
 def _load_users():
     global REGISTERED_USERS
     try:
@@ -652,8 +662,46 @@ def load_recent(conv: str, limit: int):
         return []
 
 
+HIST_SEND_BATCH = 65536
+
+def _send_history(conn: socket.socket, prefix: str, rows):
+    # history rows go out in ~64 KiB sendalls instead of one small write per row
+    buf = []
+    size = 0
+    try:
+        for sender, ts, txt in rows:
+            b = f"{prefix} {sender} {ts} {txt}\n".encode("utf-8")
+            buf.append(b)
+            size += len(b)
+            if size >= HIST_SEND_BATCH:
+                conn.sendall(b"".join(buf))
+                buf = []
+                size = 0
+        if buf:
+            conn.sendall(b"".join(buf))
+    except Exception:
+        pass
+
+
+class _LineReader:
+    # binary reader with a 64 KiB buffer; lines are split in C and decoded once each,
+    # instead of going through a text-mode wrapper that decodes in small pieces
+    def __init__(self, conn: socket.socket):
+        self._f = conn.makefile("rb", buffering=65536)
+
+    def readline(self) -> str:
+        return self._f.readline().decode("utf-8", "replace")
+
+    def __iter__(self):
+        for raw in self._f:
+            yield raw.decode("utf-8", "replace")
+
+    def close(self):
+        self._f.close()
+
+
 def handle_client(conn: socket.socket, addr, hub: Hub):
-    f = conn.makefile("r", encoding="utf-8", newline="\n")
+    f = _LineReader(conn)
     username = addr[0]
     room = "世界"
     if not REGISTERED_USERS:
@@ -858,17 +906,9 @@ def handle_client(conn: socket.socket, addr, hub: Hub):
                         if h:
                             kind, p, n = h
                             if kind == "GROUP":
-                                for sender, ts, txt in load_recent(conv_group(room), n):
-                                    try:
-                                        conn.sendall(f"[SYS] HISTORY GROUP {room} {sender} {ts} {txt}\n".encode("utf-8"))
-                                    except Exception:
-                                        pass
+                                _send_history(conn, f"[SYS] HISTORY GROUP {room}", load_recent(conv_group(room), n))
                             else:
-                                for sender, ts, txt in load_recent(conv_dm(username, p), n):
-                                    try:
-                                        conn.sendall(f"[SYS] HISTORY DM {p} {sender} {ts} {txt}\n".encode("utf-8"))
-                                    except Exception:
-                                        pass
+                                _send_history(conn, f"[SYS] HISTORY DM {p}", load_recent(conv_dm(username, p), n))
                         else:
                             up = parse_avatar_upload(body)
                             if up:
@@ -945,17 +985,9 @@ def handle_client(conn: socket.socket, addr, hub: Hub):
                 if h:
                     kind, p, n = h
                     if kind == "GROUP":
-                        for sender, ts, txt in load_recent(conv_group(room), n):
-                            try:
-                                conn.sendall(f"[SYS] HISTORY GROUP {room} {sender} {ts} {txt}\n".encode("utf-8"))
-                            except Exception:
-                                pass
+                        _send_history(conn, f"[SYS] HISTORY GROUP {room}", load_recent(conv_group(room), n))
                     else:
-                        for sender, ts, txt in load_recent(conv_dm(username, p), n):
-                            try:
-                                conn.sendall(f"[SYS] HISTORY DM {p} {sender} {ts} {txt}\n".encode("utf-8"))
-                            except Exception:
-                                pass
+                        _send_history(conn, f"[SYS] HISTORY DM {p}", load_recent(conv_dm(username, p), n))
                     if seq is not None:
                         try:
                             conn.sendall((f"[ACK] {seq}\n").encode("utf-8"))
@@ -1048,17 +1080,9 @@ def handle_client(conn: socket.socket, addr, hub: Hub):
             if h:
                 kind, p, n = h
                 if kind == "GROUP":
-                    for sender, ts, txt in load_recent(conv_group(room), n):
-                        try:
-                            conn.sendall(f"[SYS] HISTORY GROUP {room} {sender} {ts} {txt}\n".encode("utf-8"))
-                        except Exception:
-                            pass
+                    _send_history(conn, f"[SYS] HISTORY GROUP {room}", load_recent(conv_group(room), n))
                 else:
-                    for sender, ts, txt in load_recent(conv_dm(username, p), n):
-                        try:
-                            conn.sendall(f"[SYS] HISTORY DM {p} {sender} {ts} {txt}\n".encode("utf-8"))
-                        except Exception:
-                            pass
+                    _send_history(conn, f"[SYS] HISTORY DM {p}", load_recent(conv_dm(username, p), n))
                 if seq is not None:
                     try:
                         conn.sendall((f"[ACK] {seq}\n").encode("utf-8"))
@@ -1136,6 +1160,54 @@ def start_server(host: str, port: int):
         if ThreadingHTTPServer and BaseHTTPRequestHandler:
             def start_status_server():
                 class H(BaseHTTPRequestHandler):
+                    # HTTP/1.1 so clients (the upload pool, browsers) can reuse a connection.
+                    # A response is only kept alive when it carried a Content-Length and, for
+                    # POST, the request body was read in full; anything else closes as before.
+                    protocol_version = "HTTP/1.1"
+                    # drop idle keep-alive connections instead of parking a thread on them
+                    timeout = 30
+
+                    def handle_one_request(self):
+                        self._responded = False
+                        self._sent_length = False
+                        self._body_read = False
+                        self._interim = False
+                        super().handle_one_request()
+                        if not self._responded:
+                            self.close_connection = True
+
+                    def send_response_only(self, code, message=None):
+                        # 1xx (the "100 Continue" from handle_expect_100) is not the response
+                        # and carries no body, so it must not decide keep-alive
+                        self._interim = code < 200
+                        if not self._interim:
+                            self._responded = True
+                            self._sent_length = False
+                        super().send_response_only(code, message)
+
+                    def send_header(self, keyword, value):
+                        if keyword.lower() == "content-length":
+                            self._sent_length = True
+                        super().send_header(keyword, value)
+
+                    def end_headers(self):
+                        if not self._interim and not self.close_connection and (not self._sent_length or (self.command == "POST" and not self._body_read)):
+                            super().send_header("Connection", "close")
+                            self.close_connection = True
+                        super().end_headers()
+
+                    def _read_body(self) -> bytes:
+                        try:
+                            n = int(self.headers.get("Content-Length") or "0")
+                        except Exception:
+                            n = 0
+                        try:
+                            raw = self.rfile.read(n) if n > 0 else b""
+                        except Exception:
+                            return b""
+                        self._body_read = (len(raw) == max(0, n))
+                        return raw
+
                     def _get_file_info(self):
                         try:
                             p = self.path.split("?", 1)[0]
@@ -1168,22 +1240,28 @@ def start_server(host: str, port: int):
                             pass
                         return False
 
+                    # the page only varies by a fixed error message, so each variant is encoded once
+                    _login_page_cache = {}
+
                     def _login_page(self, error=""):
-                        html = f"""
-                        <html><head><meta charset="utf-8"><title>XiaoCaiChat Server Login v{SERVER_VERSION}</title>
-                        <style>body{{font-family:-apple-system,Helvetica,Arial,sans-serif;padding:40px;display:flex;justify-content:center;align-items:center;height:100vh;background-color:#f5f5f5;margin:0}}.login-box{{background:white;padding:30px;border-radius:8px;box-shadow:0 2px 10px rgba(0,0,0,0.1);width:300px}}h1{{font-size:20px;margin:0 0 20px;text-align:center}}input{{width:100%;padding:10px;margin-bottom:10px;border:1px solid #ddd;border-radius:4px;box-sizing:border-box}}button{{width:100%;padding:10px;background:#007bff;color:white;border:none;border-radius:4px;cursor:pointer}}button:hover{{background:#0056b3}}.error{{color:red;font-size:14px;margin-bottom:10px;text-align:center}}</style>
-                        </head><body>
-                        <div class="login-box">
-                            <h1>管理员登录 (v{SERVER_VERSION})</h1>
-                            {f'<div class="error">{error}</div>' if error else ''}
-                            <form method="post" action="/api/admin_login">
-                                <input type="password" name="password" placeholder="请输入密码" required>
-                                <button type="submit">登录</button>
-                            </form>
-                        </div>
-                        </body></html>
-                        """
-                        b = html.encode("utf-8")
+                        b = self._login_page_cache.get(error)
+                        if b is None:
+                            html = f"""
+                            <html><head><meta charset="utf-8"><title>XiaoCaiChat Server Login v{SERVER_VERSION}</title>
+                            <style>body{{font-family:-apple-system,Helvetica,Arial,sans-serif;padding:40px;display:flex;justify-content:center;align-items:center;height:100vh;background-color:#f5f5f5;margin:0}}.login-box{{background:white;padding:30px;border-radius:8px;box-shadow:0 2px 10px rgba(0,0,0,0.1);width:300px}}h1{{font-size:20px;margin:0 0 20px;text-align:center}}input{{width:100%;padding:10px;margin-bottom:10px;border:1px solid #ddd;border-radius:4px;box-sizing:border-box}}button{{width:100%;padding:10px;background:#007bff;color:white;border:none;border-radius:4px;cursor:pointer}}button:hover{{background:#0056b3}}.error{{color:red;font-size:14px;margin-bottom:10px;text-align:center}}</style>
+                            </head><body>
+                            <div class="login-box">
+                                <h1>管理员登录 (v{SERVER_VERSION})</h1>
+                                {f'<div class="error">{error}</div>' if error else ''}
+                                <form method="post" action="/api/admin_login">
+                                    <input type="password" name="password" placeholder="请输入密码" required>
+                                    <button type="submit">登录</button>
+                                </form>
+                            </div>
+                            </body></html>
+                            """
+                            b = html.encode("utf-8")
+                            self._login_page_cache[error] = b
                         self.send_response(200)
                         self.send_header("Content-Type", "text/html; charset=utf-8")
                         self.send_header("Content-Length", str(len(b)))
@@ -1193,6 +1271,49 @@ def start_server(host: str, port: int):
                         except Exception:
                             pass
 
+                    def _send_file(self, fpath, fname, log_fid=None):
+                        # streams the file with the size taken from the open descriptor;
+                        # socket.sendfile uses os.sendfile where available, so the body
+                        # never has to be held in memory
+                        f = None
+                        sz = 0
+                        try:
+                            f = open(fpath, "rb")
+                            sz = os.fstat(f.fileno()).st_size
+                        except Exception:
+                            f = None
+                            sz = 0
+                        try:
+                            if log_fid is not None:
+                                try:
+                                    print(f"[HTTP] GET /files - serve fid={log_fid} name={fname} size={sz}")
+                                except Exception:
+                                    pass
+                            self.send_response(200)
+                            self.send_header("Content-Type", "application/octet-stream")
+                            self.send_header("Content-Length", str(sz))
+                            try:
+                                self.send_header("Content-Disposition", f'attachment; filename="{fname}"')
+                            except Exception:
+                                pass
+                            self.end_headers()
+                            if f is not None and sz > 0:
+                                try:
+                                    self.wfile.flush()
+                                    # short when the file shrank after fstat (e.g. the installer
+                                    # being rewritten); the client is still owed the rest
+                                    if self.connection.sendfile(f, 0, sz) < sz:
+                                        self.close_connection = True
+                                except Exception:
+                                    # body cut short: the connection can't carry another response
+                                    self.close_connection = True
+                        finally:
+                            if f is not None:
+                                try:
+                                    f.close()
+                                except Exception:
+                                    pass
+
                     def do_HEAD(self):
                         try:
                             p = self.path.split("?", 1)[0]
@@ -1248,23 +1369,7 @@ def start_server(host: str, port: int):
                                     self.send_response(404)
                                     self.end_headers()
                                     return
-                                try:
-                                    with open(fpath, "rb") as f:
-                                        data = f.read()
-                                except Exception:
-                                    data = b""
-                                self.send_response(200)
-                                self.send_header("Content-Type", "application/octet-stream")
-                                self.send_header("Content-Length", str(len(data)))
-                                try:
-                                    self.send_header("Content-Disposition", f'attachment; filename="{os.path.basename(fpath)}"')
-                                except Exception:
-                                    pass
-                                self.end_headers()
-                                try:
-                                    self.wfile.write(data)
-                                except Exception:
-                                    pass
+                                self._send_file(fpath, os.path.basename(fpath))
                                 return
                             if p.startswith("/files/"):
                                 fid, fname, fpath = self._get_file_info()
@@ -1276,27 +1381,7 @@ def start_server(host: str, port: int):
                                     self.send_response(404)
                                     self.end_headers()
                                     return
-                                try:
-                                    with open(fpath, "rb") as f:
-                                        data = f.read()
-                                except Exception:
-                                    data = b""
-                                try:
-                                    print(f"[HTTP] GET /files - serve fid={fid} name={fname} size={len(data)}")
-                                except Exception:
-                                    pass
-                                self.send_response(200)
-                                self.send_header("Content-Type", "application/octet-stream")
-                                self.send_header("Content-Length", str(len(data)))
-                                try:
-                                    self.send_header("Content-Disposition", f'attachment; filename="{fname}"')
-                                except Exception:
-                                    pass
-                                self.end_headers()
-                                try:
-                                    self.wfile.write(data)
-                                except Exception:
-                                    pass
+                                self._send_file(fpath, fname, log_fid=fid)
                                 return
                             if p == "/api/status":
                                 rooms = list(hub.rooms.keys())
@@ -1468,14 +1553,7 @@ def start_server(host: str, port: int):
                         except Exception:
                             pass
                     def _read_form(self):
-                        try:
-                            n = int(self.headers.get("Content-Length") or "0")
-                        except Exception:
-                            n = 0
-                        try:
-                            body = self.rfile.read(n) if n > 0 else b""
-                        except Exception:
-                            body = b""
+                        body = self._read_body()
                         try:
                             s = body.decode("utf-8")
                             d = {}
@@ -1500,7 +1578,7 @@ def start_server(host: str, port: int):
                                 pwd = form.get("password", [""])[-1]
                                 if pwd == ADMIN_PASSWORD:
                                     token = str(uuid.uuid4())
-                                    ADMIN_SESSIONS.add(token)
+                                    _add_admin_session(token)
                                     self.send_response(302)
                                     self.send_header("Location", "/")
                                     self.send_header("Set-Cookie", f"admin_session={token}; Path=/; HttpOnly")
@@ -1518,14 +1596,7 @@ def start_server(host: str, port: int):
 
                             if p == "/api/upload_file":
                                 # read raw body first to allow robust parsing
-                                try:
-                                    n = int(self.headers.get("Content-Length") or "0")
-                                except Exception:
-                                    n = 0
-                                try:
-                                    raw = self.rfile.read(n) if n > 0 else b""
-                                except Exception:
-                                    raw = b""
+                                raw = self._read_body()
                                 # primary: cgi.FieldStorage over buffered body
                                 try:
                                     form = cgi.FieldStorage(
@@ -1676,14 +1747,7 @@ def start_server(host: str, port: int):
                                     pass
                                 return
                             if p == "/api/set_client_release":
-                                try:
-                                    n = int(self.headers.get("Content-Length") or "0")
-                                except Exception:
-                                    n = 0
-                                try:
-                                    raw = self.rfile.read(n) if n > 0 else b""
-                                except Exception:
-                                    raw = b""
+                                raw = self._read_body()
                                 try:
                                     form = cgi.FieldStorage(
                                         fp=io.BytesIO(raw),
@@ -1986,6 +2050,12 @@ def start_server(host: str, port: int):
     try:
         while True:
             conn, addr = srv.accept()
+            try:
+                # small interactive lines: no Nagle delay; keepalive culls peers that vanished
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            except Exception:
+                pass
             t = threading.Thread(target=handle_client, args=(conn, addr, hub), daemon=True)
             t.start()
     except KeyboardInterrupt:
@@ -1,9 +1,15 @@
+import atexit
 import os
 import threading
-from datetime import datetime
+import time
 
 
 class ChatLogger:
+    # the file stays open with a buffer; it is flushed every FLUSH_LINES lines,
+    # on the first write after FLUSH_SECS, and on close()/interpreter exit
+    FLUSH_LINES = 64
+    FLUSH_SECS = 1.0
+
     def __init__(self, log_dir: str, peer_label: str):
         self.log_dir = log_dir
         try:
@@ -20,15 +26,34 @@ class ChatLogger:
                     os.makedirs(self.log_dir, exist_ok=True)
                 except Exception:
                     pass
-        date = datetime.now().strftime("%Y%m%d")
-        fname = f"chat_{peer_label}_{date}.log"
-        self.path = os.path.join(self.log_dir, fname)
+        self.peer_label = peer_label
+        # (epoch second, "HH:MM:SS", "YYYYMMDD") for the last second a line was logged in
+        self._clock = (0, "", "")
+        self._date = self._now()[2]
+        self.path = self._path_for(self._date)
         self.lock = threading.Lock()
+        self._fp = None
+        self._pending = 0
+        self._last_flush = time.monotonic()
+        atexit.register(self.close)
+
+    def _path_for(self, date: str) -> str:
+        return os.path.join(self.log_dir, f"chat_{self.peer_label}_{date}.log")
+
+    def _now(self):
+        # timestamps are formatted once per second, not once per line
+        sec = int(time.time())
+        clock = self._clock
+        if clock[0] != sec:
+            lt = time.localtime(sec)
+            clock = (sec, time.strftime("%H:%M:%S", lt), time.strftime("%Y%m%d", lt))
+            self._clock = clock
+        return clock
 
     def write(self, direction: str, username: str, text: str):
-        ts = datetime.now().strftime("%H:%M:%S")
         if text.startswith("PONG ") or text.startswith("[ACK] "):
             return
+        _, ts, date = self._now()
         if text.startswith("[FILE] "):
             s = text.strip()
             tokens = s.split(" ")
@@ -43,5 +68,33 @@ class ChatLogger:
             msg = text if len(text) <= 512 else (text[:512] + "...")
             line = f"[{ts}] {direction} {username}: {msg}\n"
         with self.lock:
-            with open(self.path, "a", encoding="utf-8") as f:
-                f.write(line)
+            if date != self._date:
+                # new day: continue in that day's file
+                if self._fp is not None:
+                    try:
+                        self._fp.close()
+                    except Exception:
+                        pass
+                    self._fp = None
+                    self._pending = 0
+                self._date = date
+                self.path = self._path_for(date)
+            if self._fp is None:
+                self._fp = open(self.path, "a", encoding="utf-8", buffering=64 * 1024)
+            self._fp.write(line)
+            self._pending += 1
+            now = time.monotonic()
+            if self._pending >= self.FLUSH_LINES or now - self._last_flush >= self.FLUSH_SECS:
+                self._fp.flush()
+                self._pending = 0
+                self._last_flush = now
+
+    def close(self):
+        with self.lock:
+            fp, self._fp = self._fp, None
+            self._pending = 0
+            if fp is not None:
+                try:
+                    fp.close()
+                except Exception:
+                    pass
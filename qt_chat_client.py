@@ -7,13 +7,21 @@ import sys
 import shutil
 import getpass
 import base64
+import binascii
 import json
 import hmac
 import hashlib
+import secrets
+import select
 import time
 import re
 import math
+import collections
+import contextlib
+import functools
+import mimetypes
 import urllib.request
+import http.client
 import urllib.error
 import urllib.parse
 
@@ -27,6 +35,116 @@ except ImportError:
 from chat_utils import ChatLogger
 from chat_local_store import LocalStore
 
+_EXT_MIME = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".gif": "image/gif",
+    ".txt": "text/plain",
+}
+
+
+# object replacement char (embedded images) and zero-width spaces/joiners
+_STRIP_CHARS = dict.fromkeys(map(ord, "\uFFFC\u200b\u200c\u200d"))
+
+
+@functools.lru_cache(maxsize=512)
+def _mimetypes_guess(ext: str) -> Optional[str]:
+    return mimetypes.guess_type("x" + ext)[0]
+
+
+def _write_b64(path: str, b64: str) -> int:
+    # decode in 64 KiB slices (a multiple of 4 chars) so the whole file is never in memory at once.
+    # Bad base64 can surface in any slice, so decode into a temp file and only replace `path`
+    # once every slice has decoded; on error an existing file is left untouched
+    n = 0
+    step = 65536
+    if len(b64) % 4:
+        step = len(b64) or 1
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            for i in range(0, len(b64), step):
+                data = binascii.a2b_base64(b64[i:i + step])
+                f.write(data)
+                n += len(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return n
+
+
+def _set_chat_sockopts(s: socket.socket):
+    # chat lines are small and interactive: send them now instead of waiting on Nagle,
+    # and let the OS notice a peer that vanished without a FIN
+    try:
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except Exception:
+        pass
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    except Exception:
+        pass
+
+
+def _grayscale_image(img: QtGui.QImage) -> QtGui.QImage:
+    # Qt does the luminance pass natively; Grayscale8 has no alpha, so put it back
+    src = img.convertToFormat(QtGui.QImage.Format_ARGB32)
+    out = src.convertToFormat(QtGui.QImage.Format_Grayscale8).convertToFormat(QtGui.QImage.Format_ARGB32)
+    if src.hasAlphaChannel():
+        out.setAlphaChannel(src.convertToFormat(QtGui.QImage.Format_Alpha8))
+    return out
+
+
+_LETTER_AVATAR_CACHE = {}
+
+
+def _letter_avatar_pixmap(ch: str, hue: int) -> QtGui.QPixmap:
+    key = (ch, hue)
+    pm = _LETTER_AVATAR_CACHE.get(key)
+    if pm is not None:
+        return pm
+    pm = QtGui.QPixmap(48, 48)
+    pm.fill(QtCore.Qt.transparent)
+    p = QtGui.QPainter(pm)
+    p.setRenderHint(QtGui.QPainter.Antialiasing, True)
+    p.setBrush(QtGui.QColor.fromHsl(hue, 160, 160))
+    p.setPen(QtCore.Qt.NoPen)
+    p.drawEllipse(0, 0, 48, 48)
+    p.setPen(QtGui.QColor(255, 255, 255))
+    f = p.font(); f.setBold(True); p.setFont(f)
+    p.drawText(QtCore.QRect(0, 0, 48, 48), QtCore.Qt.AlignCenter, ch)
+    p.end()
+    _LETTER_AVATAR_CACHE[key] = pm
+    return pm
+
+
+class ProfileIconDelegate(QtWidgets.QStyledItemDelegate):
+    """Supplies profile avatars at paint time instead of when the list is filled."""
+
+    def initStyleOption(self, option, index):
+        super().initStyleOption(option, index)
+        try:
+            name = index.data(QtCore.Qt.DisplayRole) or ""
+            path = index.data(QtCore.Qt.UserRole)
+            key = path or f"letter:{name}"
+            pm = QtGui.QPixmapCache.find(key)
+            if pm is None or pm.isNull():
+                pm = QtGui.QPixmap(path) if path else QtGui.QPixmap()
+                if pm.isNull():
+                    # fallback letter icon
+                    hue = (sum(ord(c) for c in name) % 360)
+                    pm = _letter_avatar_pixmap(name[:1], hue)
+                QtGui.QPixmapCache.insert(key, pm)
+            option.icon = QtGui.QIcon(pm)
+            option.features |= QtWidgets.QStyleOptionViewItem.HasDecoration
+        except Exception:
+            pass
+
 
 class Receiver(QtCore.QThread):
     received = QtCore.Signal(str)
@@ -37,31 +155,40 @@ class Receiver(QtCore.QThread):
         self.running = False
         self.f = None
 
+    RECV_SIZE = 65536
+
     def run(self):
         self.running = True
-        try:
-            self.f = self.sock.makefile("r", encoding="utf-8", newline="\n")
-        except Exception:
-            self.f = None
-        
+        # one recv drains whatever the kernel has buffered; every complete line in it
+        # is split out here instead of going through a text-mode readline per line
+        buf = bytearray()
         try:
             while self.running:
-                if not self.f:
-                    break
                 try:
-                    line = self.f.readline()
+                    data = self.sock.recv(self.RECV_SIZE)
                 except Exception as e:
-                    print(f"[Receiver] readline error: {e}")
+                    print(f"[Receiver] recv error: {e}")
                     break
-                if not line:
-                    print("[Receiver] readline empty (EOF)")
+                if not data:
+                    print("[Receiver] recv empty (EOF)")
                     break
-                t = line.rstrip("\n")
-                if t:
-                    try:
-                        self.received.emit(t)
-                    except Exception:
-                        pass
+                # only the new bytes can hold a newline; long FILE_CHUNK lines span many recvs
+                scan = len(buf)
+                buf += data
+                pos = 0
+                while True:
+                    i = buf.find(b"\n", scan)
+                    if i < 0:
+                        break
+                    t = buf[pos:i].decode("utf-8", "replace")
+                    pos = scan = i + 1
+                    if t:
+                        try:
+                            self.received.emit(t)
+                        except Exception:
+                            pass
+                if pos:
+                    del buf[:pos]
         except Exception as e:
             print(f"[Receiver] Loop exception: {e}")
         finally:
@@ -114,6 +241,10 @@ class ChatModel(QtCore.QAbstractListModel):
         super().__init__()
         self.items = []
         self.last_time = None
+        # (sender, filename) -> number of file rows, so name-collision checks skip a full scan
+        self.file_names = {}
+        # set while history is loading; called once before the next live row is appended
+        self.before_append = None
 
     def rowCount(self, parent=QtCore.QModelIndex()):
         return len(self.items)
@@ -154,9 +285,10 @@ class ChatModel(QtCore.QAbstractListModel):
             return item.get("quote")
         return None
 
-    def add(self, kind: str, sender: str, text: str, is_self: bool, avatar: Optional[QtGui.QPixmap] = None, ts: Optional[int] = None):
-        now = QtCore.QDateTime.fromSecsSinceEpoch(int(ts)) if ts is not None else QtCore.QDateTime.currentDateTime()
-        
+    def _when(self, ts: Optional[int]) -> QtCore.QDateTime:
+        return QtCore.QDateTime.fromSecsSinceEpoch(int(ts)) if ts is not None else QtCore.QDateTime.currentDateTime()
+
+    def _msg_item(self, kind: str, sender: str, text: str, is_self: bool, avatar: Optional[QtGui.QPixmap]) -> dict:
         quote_data = None
         display_text = text
         if kind == "msg" and text and "\x1f" in text:
@@ -166,23 +298,54 @@ class ChatModel(QtCore.QAbstractListModel):
                 quote_data = json.loads(parts[1])
             except Exception:
                 display_text = text
+        return {"kind": kind, "sender": sender, "text": display_text, "quote": quote_data, "self": is_self, "avatar": avatar}
+
+    def _file_item(self, sender: str, filename: str, mime: str, pixmap: Optional[QtGui.QPixmap], is_self: bool, avatar: Optional[QtGui.QPixmap], size_bytes: Optional[int], link_url: Optional[str] = None) -> dict:
+        return {"kind": "file", "sender": sender, "text": filename, "self": is_self, "pixmap": pixmap, "filename": filename, "mime": mime, "avatar": avatar, "filesize": (int(size_bytes) if size_bytes is not None else None), "upload_sent": None, "upload_state": None, "upload_alpha": None, "link_url": link_url}
+
+    def _index_file(self, item: dict, delta: int):
+        if item.get("kind") != "file":
+            return
+        k = (item.get("sender"), item.get("filename"))
+        n = self.file_names.get(k, 0) + delta
+        if n > 0:
+            self.file_names[k] = n
+        else:
+            self.file_names.pop(k, None)
 
+    def _append(self, now: QtCore.QDateTime, item: dict):
+        if self.before_append is not None:
+            cb, self.before_append = self.before_append, None
+            cb()
         self._maybe_time_separator(now)
+        item["time"] = now
+        self._index_file(item, 1)
         self.beginInsertRows(QtCore.QModelIndex(), len(self.items), len(self.items))
-        self.items.append({"kind": kind, "sender": sender, "text": display_text, "quote": quote_data, "self": is_self, "time": now, "avatar": avatar})
+        self.items.append(item)
         self.endInsertRows()
 
+    def add(self, kind: str, sender: str, text: str, is_self: bool, avatar: Optional[QtGui.QPixmap] = None, ts: Optional[int] = None):
+        self._append(self._when(ts), self._msg_item(kind, sender, text, is_self, avatar))
+
     def add_file(self, sender: str, filename: str, mime: str, pixmap: Optional[QtGui.QPixmap], is_self: bool, avatar: Optional[QtGui.QPixmap] = None, ts: Optional[int] = None, size_bytes: Optional[int] = None):
-        now = QtCore.QDateTime.fromSecsSinceEpoch(int(ts)) if ts is not None else QtCore.QDateTime.currentDateTime()
-        self._maybe_time_separator(now)
-        self.beginInsertRows(QtCore.QModelIndex(), len(self.items), len(self.items))
-        self.items.append({"kind": "file", "sender": sender, "text": filename, "self": is_self, "time": now, "pixmap": pixmap, "filename": filename, "mime": mime, "avatar": avatar, "filesize": (int(size_bytes) if size_bytes is not None else None), "upload_sent": None, "upload_state": None, "upload_alpha": None, "link_url": None})
-        self.endInsertRows()
+        self._append(self._when(ts), self._file_item(sender, filename, mime, pixmap, is_self, avatar, size_bytes))
     def add_link(self, sender: str, filename: str, url: str, is_self: bool, avatar: Optional[QtGui.QPixmap] = None, ts: Optional[int] = None, size_bytes: Optional[int] = None):
-        now = QtCore.QDateTime.fromSecsSinceEpoch(int(ts)) if ts is not None else QtCore.QDateTime.currentDateTime()
-        self._maybe_time_separator(now)
-        self.beginInsertRows(QtCore.QModelIndex(), len(self.items), len(self.items))
-        self.items.append({"kind": "file", "sender": sender, "text": filename, "self": is_self, "time": now, "pixmap": None, "filename": filename, "mime": "application/x-download", "avatar": avatar, "filesize": (int(size_bytes) if size_bytes is not None else None), "upload_sent": None, "upload_state": None, "upload_alpha": None, "link_url": url})
+        self._append(self._when(ts), self._file_item(sender, filename, "application/x-download", None, is_self, avatar, size_bytes, url))
+    def add_batch(self, entries: list):
+        # entries: [(ts, item)] built with _msg_item/_file_item; inserted with one rowsInserted
+        new_items = []
+        for ts, item in entries:
+            now = self._when(ts)
+            sep = self._separator_item(now)
+            if sep:
+                new_items.append(sep)
+            item["time"] = now
+            self._index_file(item, 1)
+            new_items.append(item)
+        if not new_items:
+            return
+        self.beginInsertRows(QtCore.QModelIndex(), len(self.items), len(self.items) + len(new_items) - 1)
+        self.items.extend(new_items)
         self.endInsertRows()
     def set_upload_progress(self, row: int, sent: Optional[int] = None, total: Optional[int] = None, state: Optional[str] = None):
         if 0 <= row < len(self.items):
@@ -193,18 +356,16 @@ class ChatModel(QtCore.QAbstractListModel):
                 it["filesize"] = int(max(0, total))
             if state is not None:
                 it["upload_state"] = state
-            top = self.index(row)
-            bottom = self.index(row)
-            self.dataChanged.emit(top, bottom)
+            idx = self.index(row)
+            self.dataChanged.emit(idx, idx, [ChatModel.UploadSentRole, ChatModel.FileSizeRole, ChatModel.UploadStateRole])
     def set_upload_alpha(self, row: int, alpha: Optional[int]):
         if 0 <= row < len(self.items):
             it = self.items[row]
             it["upload_alpha"] = (int(alpha) if alpha is not None else None)
-            top = self.index(row)
-            bottom = self.index(row)
-            self.dataChanged.emit(top, bottom)
+            idx = self.index(row)
+            self.dataChanged.emit(idx, idx, [ChatModel.UploadAlphaRole])
 
-    def _maybe_time_separator(self, now: QtCore.QDateTime):
+    def _separator_item(self, now: QtCore.QDateTime) -> Optional[dict]:
         should = False
         if self.last_time is None:
             should = True
@@ -213,32 +374,40 @@ class ChatModel(QtCore.QAbstractListModel):
             # 3 minutes = 180 seconds
             if delta > 180 or self.last_time.date().daysTo(now.date()) != 0:
                 should = True
-        
-        if should:
-            cur_day = now.toString("yyyy-MM-dd")
-            today_day = QtCore.QDate.currentDate().toString("yyyy-MM-dd")
-            yesterday_day = QtCore.QDate.currentDate().addDays(-1).toString("yyyy-MM-dd")
-            hhmm = now.toString("HH:mm")
-            if cur_day == today_day:
-                label = hhmm
-            elif cur_day == yesterday_day:
-                label = f"昨天 {hhmm}"
-            else:
-                label = f"{cur_day} {hhmm}"
+        self.last_time = now
+        if not should:
+            return None
+        cur_day = now.toString("yyyy-MM-dd")
+        today_day = QtCore.QDate.currentDate().toString("yyyy-MM-dd")
+        yesterday_day = QtCore.QDate.currentDate().addDays(-1).toString("yyyy-MM-dd")
+        hhmm = now.toString("HH:mm")
+        if cur_day == today_day:
+            label = hhmm
+        elif cur_day == yesterday_day:
+            label = f"昨天 {hhmm}"
+        else:
+            label = f"{cur_day} {hhmm}"
+        return {"kind": "sys", "sender": "", "text": f"—— {label} ——", "self": False, "time": now}
+
+    def _maybe_time_separator(self, now: QtCore.QDateTime):
+        sep = self._separator_item(now)
+        if sep:
             self.beginInsertRows(QtCore.QModelIndex(), len(self.items), len(self.items))
-            self.items.append({"kind": "sys", "sender": "", "text": f"—— {label} ——", "self": False, "time": now})
+            self.items.append(sep)
             self.endInsertRows()
-        self.last_time = now
 
     def clear(self):
         self.beginResetModel()
         self.items = []
         self.last_time = None
+        self.file_names = {}
+        self.before_append = None
         self.endResetModel()
 
     def remove_row(self, row: int):
         if 0 <= row < len(self.items):
             self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+            self._index_file(self.items[row], -1)
             del self.items[row]
             self.endRemoveRows()
 
@@ -1368,19 +1537,8 @@ class ChatInput(QtWidgets.QTextEdit):
             return 300
 
     def _guess_mime(self, path: str) -> str:
-        try:
-            ext = os.path.splitext(path)[1].lower()
-            if ext in [".png"]:
-                return "image/png"
-            if ext in [".jpg", ".jpeg"]:
-                return "image/jpeg"
-            if ext in [".gif"]:
-                return "image/gif"
-            import mimetypes
-            m, _ = mimetypes.guess_type(path)
-            return m or "application/octet-stream"
-        except Exception:
-            return "application/octet-stream"
+        ext = os.path.splitext(path)[1].lower()
+        return _EXT_MIME.get(ext) or _mimetypes_guess(ext) or "application/octet-stream"
 
 class SidebarItem(QtWidgets.QFrame):
     clicked = QtCore.Signal()
@@ -1434,14 +1592,7 @@ class SidebarItem(QtWidgets.QFrame):
             pass
 
     def _guess_mime(self, path: str) -> str:
-        ext = os.path.splitext(path)[1].lower()
-        if ext in [".png"]:
-            return "image/png"
-        if ext in [".jpg", ".jpeg"]:
-            return "image/jpeg"
-        if ext in [".gif"]:
-            return "image/gif"
-        return "application/octet-stream"
+        return _EXT_MIME.get(os.path.splitext(path)[1].lower(), "application/octet-stream")
 
 class ChatSplitter(QtWidgets.QSplitter):
     def resizeEvent(self, event):
@@ -1529,14 +1680,22 @@ class FileUploadWorker(QtCore.QThread):
         self.chunk = int(max(1024, chunk))
         self._paused = False
         self._canceled = False
+        # set while running; a paused loop blocks on it and wakes as soon as resume/cancel sets it
+        self._resume_evt = threading.Event()
+        self._resume_evt.set()
     def pause_toggle(self):
         try:
             self._paused = not self._paused
+            if self._paused:
+                self._resume_evt.clear()
+            else:
+                self._resume_evt.set()
         except Exception:
             pass
     def cancel(self):
         try:
             self._canceled = True
+            self._resume_evt.set()
         except Exception:
             pass
     def run(self):
@@ -1566,7 +1725,7 @@ class FileUploadWorker(QtCore.QThread):
                     if self._canceled:
                         break
                     if self._paused:
-                        QtCore.QThread.msleep(100)
+                        self._resume_evt.wait(0.5)
                         continue
                     buf = f.read(self.chunk)
                     if not buf:
@@ -1614,7 +1773,7 @@ class FileUploadWorker(QtCore.QThread):
 class FileChunkSender(QtCore.QThread):
     progress = QtCore.Signal(int)
     finished = QtCore.Signal(bool, str)
-    def __init__(self, sock: socket.socket, path: str, filename: str, chunks: list, prefix: str, paused_ref: list, canceled_ref: list, chunk_size: int, logger: Optional[ChatLogger] = None, username: Optional[str] = None):
+    def __init__(self, sock: socket.socket, path: str, filename: str, chunks: list, prefix: str, paused_ref: list, canceled_ref: list, chunk_size: int, logger: Optional[ChatLogger] = None, username: Optional[str] = None, resume_evt: Optional[threading.Event] = None):
         super().__init__()
         self.sock = sock
         self.path = path
@@ -1626,6 +1785,7 @@ class FileChunkSender(QtCore.QThread):
         self.sz = int(max(1024, chunk_size))
         self._logger = logger
         self._log_user = username or ""
+        self._resume_evt = resume_evt
     def run(self):
         try:
             f = open(self.path, "rb")
@@ -1641,7 +1801,10 @@ class FileChunkSender(QtCore.QThread):
                 if self._canceled_ref[0]:
                     break
                 while self._paused_ref[0]:
-                    QtCore.QThread.msleep(100)
+                    if self._resume_evt is not None:
+                        self._resume_evt.wait(0.5)
+                    else:
+                        QtCore.QThread.msleep(100)
                     if self._canceled_ref[0]:
                         break
                 if self._canceled_ref[0]:
@@ -1735,6 +1898,8 @@ class MultiConnFileUploader(QtCore.QObject):
         self._override_name = override_name
         self._paused = [False]
         self._canceled = [False]
+        self._resume_evt = threading.Event()
+        self._resume_evt.set()
         self._total = 0
         self._sent = 0
         self._socks = []
@@ -1752,12 +1917,17 @@ class MultiConnFileUploader(QtCore.QObject):
     def pause_toggle(self):
         try:
             self._paused[0] = not self._paused[0]
+            if self._paused[0]:
+                self._resume_evt.clear()
+            else:
+                self._resume_evt.set()
         except Exception:
             pass
 
     def cancel(self):
         try:
             self._canceled[0] = True
+            self._resume_evt.set()
             for t in list(self._threads):
                 try:
                     t.wait(10000)
@@ -1883,7 +2053,7 @@ class MultiConnFileUploader(QtCore.QObject):
                 groups[i % len(groups)].append(off)
             threads = []
             for i, s in enumerate(self._socks):
-                t = FileChunkSender(s, self.path, name, groups[i], prefix, self._paused, self._canceled, self.chunk_size, logger=self._logger, username=self.username)
+                t = FileChunkSender(s, self.path, name, groups[i], prefix, self._paused, self._canceled, self.chunk_size, logger=self._logger, username=self.username, resume_evt=self._resume_evt)
                 t.progress.connect(self._on_piece_sent)
                 t.finished.connect(self._on_piece_finished)
                 threads.append(t)
@@ -1920,7 +2090,7 @@ class MultiConnFileUploader(QtCore.QObject):
             threads = []
             name = getattr(self, "_name", "") or os.path.basename(self.path)
             for i, s in enumerate(self._socks):
-                t = FileChunkSender(s, self.path, name, groups[i], self._prefix, self._paused, self._canceled, self.chunk_size, logger=self._logger, username=self.username)
+                t = FileChunkSender(s, self.path, name, groups[i], self._prefix, self._paused, self._canceled, self.chunk_size, logger=self._logger, username=self.username, resume_evt=self._resume_evt)
                 t.progress.connect(self._on_piece_sent)
                 t.finished.connect(self._on_piece_finished)
                 threads.append(t)
@@ -2014,6 +2184,7 @@ class MultiConnFileUploader(QtCore.QObject):
         except Exception:
             pass
 class ScreenshotEditDialog(QtWidgets.QDialog):
+    HISTORY_MAX = 32
     TOOL_PEN = 0
     TOOL_RECT = 1
     TOOL_CIRCLE = 2
@@ -2032,8 +2203,10 @@ class ScreenshotEditDialog(QtWidgets.QDialog):
         else:
              self.pixmap = pixmap
              
-        # Undo history: stack of committed pixmaps
-        self.history = [self.pixmap.copy()]
+        # Undo history: stack of committed pixmaps. Each entry is a full-size copy,
+        # so only the last HISTORY_MAX strokes stay undoable
+        self.history = collections.deque([self.pixmap.copy()], maxlen=self.HISTORY_MAX)
+        self._layer_cache = None
         
         self.current_tool = self.TOOL_PEN
         
@@ -2168,8 +2341,18 @@ class ScreenshotEditDialog(QtWidgets.QDialog):
         self.active_index = None
         self.update_display()
 
-    def update_display(self):
-        pixmap = self.history[-1].copy()
+    def _committed_layer(self) -> QtGui.QPixmap:
+        # base image plus every shape except the one being edited; dragging or resizing
+        # only changes the active shape, so this is rebuilt only when the rest changes
+        base = self.history[-1]
+        sig = tuple(
+            (shp['type'], shp['start'].x(), shp['start'].y(), shp['end'].x(), shp['end'].y())
+            for i, shp in enumerate(self.shapes) if i != self.active_index
+        )
+        cached = self._layer_cache
+        if cached is not None and cached[0] is base and cached[1] == sig:
+            return cached[2]
+        pixmap = base.copy()
         if len(self.shapes) > 0:
             painter = QtGui.QPainter(pixmap)
             try:
@@ -2190,7 +2373,13 @@ class ScreenshotEditDialog(QtWidgets.QDialog):
                         self.draw_arrow(painter, start, end)
             finally:
                 painter.end()
+        self._layer_cache = (base, sig, pixmap)
+        return pixmap
+
+    def update_display(self):
+        pixmap = self._committed_layer()
         if self.active_shape:
+            pixmap = pixmap.copy()
             painter = QtGui.QPainter(pixmap)
             try:
                 painter.setPen(QtGui.QPen(QtCore.Qt.red, 3, QtCore.Qt.SolidLine, QtCore.Qt.RoundCap, QtCore.Qt.RoundJoin))
@@ -2626,6 +2815,10 @@ class ChatWindow(QtWidgets.QWidget):
         self.rx: Optional[Receiver] = None
         self.logger = ChatLogger(log_dir, f"{host}_{port}")
         self.dm_target: Optional[str] = None
+        self._set_current_conv(None)
+        self._hydrate_token = 0
+        # conv key -> token of its outstanding history load
+        self._hydrate_pending = {}
         self.seq = 1
         self.store = LocalStore(log_dir, username)
         self.avatar_pixmap = None
@@ -2641,18 +2834,26 @@ class ChatWindow(QtWidgets.QWidget):
         self.avatar_file_map = {}
         self.rooms_info = []
         self.room_name_map = {}
-        self.socks = {}
-        self.receivers = {}
+        self.socks: dict[str, socket.socket] = {}
+        self.receivers: dict[str, Receiver] = {}
         self.max_upload_bytes = 40 * 1024 * 1024
         self.pending_dm = set()
         self.pending_dm_users = set()
         self.pending_join_users = set()
         self.online_users = set()
+        self._pending_icon_refresh = set()
+        self._icon_flush_scheduled = False
         self.conv_avatar_labels = {}
         self.upload_workers = {}
-        self._fade_timers = {}
+        self._fading_rows = {}
+        self._fade_tick: Optional[QtCore.QTimer] = None
+        self._http_pool: list = []
+        self._http_pool_lock = threading.Lock()
         self._rx_files = {}
+        self._ensured_att_dirs = set()
+        self._att_search_cache = {}
         self._finalizing_files = set()
+        self._bubble_layout_cache = collections.OrderedDict()
         try:
             app = QtWidgets.QApplication.instance()
             if app:
@@ -2999,15 +3200,7 @@ class ChatWindow(QtWidgets.QWidget):
                 w_pm = QtGui.QPixmap(w_path)
                 if not w_pm.isNull():
                     w_pm = w_pm.scaled(128, 128, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation)
-                    img = w_pm.toImage().convertToFormat(QtGui.QImage.Format_ARGB32)
-                    w = img.width()
-                    h = img.height()
-                    for y in range(h):
-                        for x in range(w):
-                            c = img.pixel(x, y)
-                            gray = int(0.299 * ((c >> 16) & 0xFF) + 0.587 * ((c >> 8) & 0xFF) + 0.114 * (c & 0xFF))
-                            alpha = (c >> 24) & 0xFF
-                            img.setPixel(x, y, (alpha << 24) | (gray << 16) | (gray << 8) | gray)
+                    img = _grayscale_image(w_pm.toImage())
                     w_pm = QtGui.QPixmap.fromImage(img)
                     welcome_label.setPixmap(w_pm)
         except Exception:
@@ -3239,6 +3432,7 @@ class ChatWindow(QtWidgets.QWidget):
             s.settimeout(None)
         except Exception:
             pass
+        _set_chat_sockopts(s)
         self.sock = s
         try:
             extra = (self.avatar_filename or "").strip() if isinstance(self.avatar_filename, str) else ""
@@ -3255,7 +3449,7 @@ class ChatWindow(QtWidgets.QWidget):
         except Exception:
             pass
         # 初始化一个空模型，等待选择私聊
-        self.current_conv = None
+        self._set_current_conv(None)
         self.current_model = ChatModel()
         self.view.setModel(self.current_model)
         self.hb = QtCore.QTimer(self)
@@ -3323,6 +3517,7 @@ class ChatWindow(QtWidgets.QWidget):
             s.settimeout(None)
         except Exception:
             pass
+        _set_chat_sockopts(s)
         try:
             extra = (self.avatar_filename or "").strip() if isinstance(self.avatar_filename, str) else ""
             hello = f"HELLO {self.username} {rid} {extra}\n".encode("utf-8")
@@ -3368,7 +3563,7 @@ class ChatWindow(QtWidgets.QWidget):
                 return ok
             # init view model once
             if not self.current_model:
-                self.current_conv = None
+                self._set_current_conv(None)
                 self.current_model = ChatModel()
                 self.view.setModel(self.current_model)
             # heartbeat timer
@@ -3614,7 +3809,7 @@ class ChatWindow(QtWidgets.QWidget):
                             self._set_online(name, False)
                     # Force refresh all icons after sync
                     for name in list(self.online_users):
-                        self._refresh_conv_icon(name)
+                        self._queue_icon_refresh(name)
                 return
             if len(parts) >= 4 and parts[1] == "ROOM_NAME":
                 room = parts[2]
@@ -3683,7 +3878,7 @@ class ChatWindow(QtWidgets.QWidget):
                         
                         pix = self._pix_from_b64(mime, b64)
                         self._save_attachment(fn, b64, f"dm:{peer}")
-                        av = self.avatar_pixmap if sender == self.username else self.peer_avatars.get(sender)
+                        av = self._av_for_sender(sender)
                         try:
                             sz = len(base64.b64decode(b64))
                         except Exception:
@@ -3700,7 +3895,7 @@ class ChatWindow(QtWidgets.QWidget):
                         if self._is_deleted(f"dm:{peer}", "msg", payload_clean, None):
                             return
                         if payload_clean:
-                            av = self.avatar_pixmap if sender == self.username else self.peer_avatars.get(sender)
+                            av = self._av_for_sender(sender)
                             self.conv_models[f"dm:{peer}"].add("msg", sender, payload_clean, sender == self.username, av, int(ts) if ts else None)
                     return
             if len(parts) >= 4 and parts[1] == "UNREAD":
@@ -4078,7 +4273,7 @@ class ChatWindow(QtWidgets.QWidget):
                 pix = self._pix_from_b64(mime, b64)
                 self._save_attachment(fn, b64, f"group:{self.room}")
                 self._ensure_conv(f"group:{self.room}")
-                av = self.avatar_pixmap if name == self.username else self.peer_avatars.get(name)
+                av = self._av_for_sender(name)
                 try:
                     sz = len(base64.b64decode(b64))
                 except Exception:
@@ -4145,7 +4340,7 @@ class ChatWindow(QtWidgets.QWidget):
                     return
                 if msg_clean:
                     self._ensure_conv(f"group:{self.room}")
-                    av = self.avatar_pixmap if name == self.username else self.peer_avatars.get(name)
+                    av = self._av_for_sender(name)
                     self.conv_models[f"group:{self.room}"].add("msg", name, msg_clean, name == self.username, av)
                     self.store.add(f"group:{self.room}", name, msg_clean, "msg", name == self.username)
             self.view.scrollToBottom()
@@ -4368,7 +4563,7 @@ class ChatWindow(QtWidgets.QWidget):
                     
                     # Force refresh all icons after sync
                     for name in list(self.online_users):
-                        self._refresh_conv_icon(name)
+                        self._queue_icon_refresh(name)
                 return
             if len(parts) >= 4 and parts[1] == "ROOM_NAME":
                 room = parts[2]
@@ -4440,7 +4635,7 @@ class ChatWindow(QtWidgets.QWidget):
                             return
                         pix = self._pix_from_b64(mime, b64)
                         self._save_attachment(fn, b64, f"dm:{peer}")
-                        av = self.avatar_pixmap if sender == self.username else self.peer_avatars.get(sender)
+                        av = self._av_for_sender(sender)
                         try:
                             sz = len(base64.b64decode(b64))
                         except Exception:
@@ -4457,7 +4652,7 @@ class ChatWindow(QtWidgets.QWidget):
                         if self._is_deleted(f"dm:{peer}", "msg", payload_clean, None):
                             return
                         if payload_clean:
-                            av = self.avatar_pixmap if sender == self.username else self.peer_avatars.get(sender)
+                            av = self._av_for_sender(sender)
                             self.conv_models[f"dm:{peer}"].add("msg", sender, payload_clean, sender == self.username, av, int(ts) if ts else None)
                     return
             if len(parts) >= 4 and parts[1] == "UNREAD":
@@ -4734,6 +4929,8 @@ class ChatWindow(QtWidgets.QWidget):
                 elif msg.startswith("FILE_CANCEL "):
                     toks = msg.split(" ", 1)
                     fn = toks[1] if len(toks) >= 2 else ""
+                    # close the part file before unlinking it
+                    self._rx_drop((f"dm:{name}", name, fn))
                     try:
                         att_dir = self._attachment_dir(f"dm:{name}")
                         part = os.path.join(att_dir, fn + ".part")
@@ -4744,12 +4941,6 @@ class ChatWindow(QtWidgets.QWidget):
                                 pass
                     except Exception:
                         pass
-                    try:
-                        k = (f"dm:{name}", name, fn)
-                        if k in self._rx_files:
-                            del self._rx_files[k]
-                    except Exception:
-                        pass
                     return
                     try:
                         k = (f"dm:{name}", name, fn)
@@ -4892,7 +5083,7 @@ class ChatWindow(QtWidgets.QWidget):
                             self._save_attachment(fn, b64, rid_key)
                         else:
                             self._save_attachment_async(fn, b64, rid_key)
-                        av = self.avatar_pixmap if name == self.username else self.peer_avatars.get(name)
+                        av = self._av_for_sender(name)
                         try:
                             sz = len(base64.b64decode(b64))
                         except Exception:
@@ -5090,6 +5281,8 @@ class ChatWindow(QtWidgets.QWidget):
             elif msg.startswith("FILE_CANCEL "):
                 toks = msg.split(" ", 1)
                 fn = toks[1] if len(toks) >= 2 else ""
+                # close the part file before unlinking it
+                self._rx_drop((rid_key, name, fn))
                 try:
                     att_dir = self._attachment_dir(rid_key)
                     part = os.path.join(att_dir, fn + ".part")
@@ -5100,12 +5293,6 @@ class ChatWindow(QtWidgets.QWidget):
                             pass
                 except Exception:
                     pass
-                try:
-                    k = (rid_key, name, fn)
-                    if k in self._rx_files:
-                        del self._rx_files[k]
-                except Exception:
-                    pass
                 return
             elif msg.startswith("file://"):
                 local_path = QtCore.QUrl(msg).toLocalFile()
@@ -5129,7 +5316,7 @@ class ChatWindow(QtWidgets.QWidget):
                     return
                 if msg_clean:
                     self._ensure_conv(rid_key)
-                    av = self.avatar_pixmap if name == self.username else self.peer_avatars.get(name)
+                    av = self._av_for_sender(name)
                     self.conv_models[rid_key].add("msg", name, msg_clean, name == self.username, av)
                     self.store.add(rid_key, name, msg_clean, "msg", name == self.username)
             self.view.scrollToBottom()
@@ -5222,8 +5409,8 @@ class ChatWindow(QtWidgets.QWidget):
         if not self.current_conv:
             return
         try:
-            if self.current_conv.startswith("group:"):
-                rid = self.current_conv.split(":",1)[1]
+            if self._conv_kind == "group":
+                rid = self._conv_target
                 if rid in getattr(self, "closed_rooms", set()):
                     return
         except Exception:
@@ -5274,14 +5461,14 @@ class ChatWindow(QtWidgets.QWidget):
                 self.pending_image_pixmap = None
                 if text:
                     wire_text = text.replace("\n", "\\n")
-                    if self.current_conv.startswith("dm:"):
-                        target = self.current_conv.split(":",1)[1]
+                    if self._conv_kind == "dm":
+                        target = self._conv_target
                         self._send_seq(f"DM {target} {wire_text}")
                         self.store.add(f"dm:{target}", self.username, text, "msg", True)
                         self._ensure_conv(self.current_conv)
                         self.conv_models[self.current_conv].add("msg", self.username, text, True, self.avatar_pixmap)
                     else:
-                        rid = self.current_conv.split(":",1)[1]
+                        rid = self._conv_target
                         self._send_seq(f"MSG {wire_text}", rid)
                         self.store.add(f"group:{rid}", self.username, text, "msg", True)
                         self._ensure_conv(self.current_conv)
@@ -5294,8 +5481,7 @@ class ChatWindow(QtWidgets.QWidget):
             uniq_name = self._ensure_unique_filename(self.current_conv, self.username, name)
             if (not is_image) and size_bytes >= limit_bytes:
                 try:
-                    att_dir = self._attachment_dir(self.current_conv)
-                    os.makedirs(att_dir, exist_ok=True)
+                    att_dir = self._ensure_att_dir(self.current_conv)
                     temp_path = os.path.join(att_dir, uniq_name)
                     with open(temp_path, "wb") as f:
                         f.write(self.pending_image_bytes)
@@ -5321,8 +5507,8 @@ class ChatWindow(QtWidgets.QWidget):
                         self.view.scrollToBottom()
                         self.entry.clear()
                         return
-                    if self.current_conv.startswith("group:"):
-                        rid = self.current_conv.split(":",1)[1]
+                    if self._conv_kind == "group":
+                        rid = self._conv_target
                         self._ensure_conv(self.current_conv)
                         self.conv_models[self.current_conv].add_file(self.username, uniq_name, mime, pix if not pix.isNull() else None, True, self.avatar_pixmap, None, sz)
                         try:
@@ -5349,7 +5535,7 @@ class ChatWindow(QtWidgets.QWidget):
                         text = "\n".join(lines).strip()
                     except Exception:
                         pass
-                    if self.current_conv.startswith("dm:"):
+                    if self._conv_kind == "dm":
                         self._start_async_upload(temp_path, uniq_name)
                 except Exception:
                     pass
@@ -5368,8 +5554,8 @@ class ChatWindow(QtWidgets.QWidget):
                 except Exception:
                     pass
                 payload_text = f"[FILE] {uniq_name} {mime} {b64}"
-                if self.current_conv.startswith("dm:"):
-                    target = self.current_conv.split(":",1)[1]
+                if self._conv_kind == "dm":
+                    target = self._conv_target
                     self._send_seq(f"DM {target} {payload_text}")
                     self.store.add(f"dm:{target}", self.username, payload_text, "file", True)
                     self.logger.write("sent", self.username, payload_text)
@@ -5381,7 +5567,7 @@ class ChatWindow(QtWidgets.QWidget):
                     except Exception:
                         pass
                 else:
-                    rid = self.current_conv.split(":",1)[1]
+                    rid = self._conv_target
                     try:
                         limit_inline = int(getattr(self, "max_upload_bytes", 40 * 1024 * 1024))
                         size_inline = len(self.pending_image_bytes) if self.pending_image_bytes is not None else 0
@@ -5396,8 +5582,7 @@ class ChatWindow(QtWidgets.QWidget):
                             except Exception:
                                 pass
                         else:
-                            att_dir = self._attachment_dir(self.current_conv)
-                            os.makedirs(att_dir, exist_ok=True)
+                            att_dir = self._ensure_att_dir(self.current_conv)
                             temp_path = os.path.join(att_dir, uniq_name)
                             with open(temp_path, "wb") as f:
                                 f.write(self.pending_image_bytes)
@@ -5422,14 +5607,14 @@ class ChatWindow(QtWidgets.QWidget):
             # If there was remaining text, send it too
             if text:
                 wire_text = text.replace("\n", "\\n")
-                if self.current_conv.startswith("dm:"):
-                    target = self.current_conv.split(":",1)[1]
+                if self._conv_kind == "dm":
+                    target = self._conv_target
                     self._send_seq(f"DM {target} {wire_text}")
                     self.store.add(f"dm:{target}", self.username, text, "msg", True)
                     self._ensure_conv(self.current_conv)
                     self.conv_models[self.current_conv].add("msg", self.username, text, True, self.avatar_pixmap)
                 else:
-                    rid = self.current_conv.split(":",1)[1]
+                    rid = self._conv_target
                     self._send_seq(f"MSG {wire_text}", rid)
                     self.store.add(f"group:{rid}", self.username, text, "msg", True)
                     self._ensure_conv(self.current_conv)
@@ -5453,10 +5638,10 @@ class ChatWindow(QtWidgets.QWidget):
                 name = self.pending_image_name or ("paste_" + str(int(QtCore.QDateTime.currentMSecsSinceEpoch())) + ".png")
                 mime = self.pending_image_mime or "image/png"
                 uniq_name = self._ensure_unique_filename(self.current_conv, self.username, name)
-                if self.current_conv.startswith("dm:"):
+                if self._conv_kind == "dm":
                     b64 = base64.b64encode(self.pending_image_bytes).decode("ascii")
                     payload_text = f"[FILE] {uniq_name} {mime} {b64}"
-                    target = self.current_conv.split(":",1)[1]
+                    target = self._conv_target
                     self._send_seq(f"DM {target} {payload_text}")
                     self.store.add(f"dm:{target}", self.username, payload_text, "file", True)
                     self.logger.write("sent", self.username, payload_text)
@@ -5468,7 +5653,7 @@ class ChatWindow(QtWidgets.QWidget):
                     except Exception:
                         pass
                 else:
-                    rid = self.current_conv.split(":",1)[1]
+                    rid = self._conv_target
                     try:
                         limit_inline = int(getattr(self, "max_upload_bytes", 40 * 1024 * 1024))
                         size_inline = len(self.pending_image_bytes) if self.pending_image_bytes is not None else 0
@@ -5486,8 +5671,7 @@ class ChatWindow(QtWidgets.QWidget):
                             except Exception:
                                 pass
                         else:
-                            att_dir = self._attachment_dir(self.current_conv)
-                            os.makedirs(att_dir, exist_ok=True)
+                            att_dir = self._ensure_att_dir(self.current_conv)
                             temp_path = os.path.join(att_dir, uniq_name)
                             with open(temp_path, "wb") as f:
                                 f.write(self.pending_image_bytes)
@@ -5533,14 +5717,14 @@ class ChatWindow(QtWidgets.QWidget):
                                 except Exception:
                                     pass
                                 wire_text = text.replace("\n", "\\n")
-                                if self.current_conv.startswith("dm:"):
-                                    target = self.current_conv.split(":",1)[1]
+                                if self._conv_kind == "dm":
+                                    target = self._conv_target
                                     self._send_seq(f"DM {target} {wire_text}")
                                     self.store.add(f"dm:{target}", self.username, text, "msg", True)
                                     self._ensure_conv(self.current_conv)
                                     self.conv_models[self.current_conv].add("msg", self.username, text, True, self.avatar_pixmap)
                                 else:
-                                    rid = self.current_conv.split(":",1)[1]
+                                    rid = self._conv_target
                                     self._send_seq(f"MSG {wire_text}", rid)
                                     self.store.add(f"group:{rid}", self.username, text, "msg", True)
                                     self._ensure_conv(self.current_conv)
@@ -5549,11 +5733,10 @@ class ChatWindow(QtWidgets.QWidget):
                                 self.logger.write("sent", self.username, wire_text)
                             self.entry.clear()
                             return
-                        if self.current_conv.startswith("group:"):
-                            rid = self.current_conv.split(":",1)[1]
+                        if self._conv_kind == "group":
+                            rid = self._conv_target
                             try:
-                                att_dir = self._attachment_dir(self.current_conv)
-                                os.makedirs(att_dir, exist_ok=True)
+                                att_dir = self._ensure_att_dir(self.current_conv)
                                 uniq_name = self._ensure_unique_filename(self.current_conv, self.username, name)
                                 dst = os.path.join(att_dir, uniq_name)
                                 try:
@@ -5616,15 +5799,15 @@ class ChatWindow(QtWidgets.QWidget):
                         pass
             if text:
                 wire_text = text.replace("\n", "\\n")
-                if self.current_conv.startswith("dm:"):
-                    target = self.current_conv.split(":",1)[1]
+                if self._conv_kind == "dm":
+                    target = self._conv_target
                     self._send_seq(f"DM {target} {wire_text}")
                     self.store.add(f"dm:{target}", self.username, text, "msg", True)
                     self._ensure_conv(self.current_conv)
                     self.conv_models[self.current_conv].add("msg", self.username, text, True, self.avatar_pixmap)
                     self.view.scrollToBottom()
                 else:
-                    rid = self.current_conv.split(":",1)[1]
+                    rid = self._conv_target
                     self._send_seq(f"MSG {wire_text}", rid)
                     self.store.add(f"group:{rid}", self.username, text, "msg", True)
                     self._ensure_conv(self.current_conv)
@@ -5846,8 +6029,8 @@ class ChatWindow(QtWidgets.QWidget):
 
     def on_send_file(self):
         try:
-            if self.current_conv and self.current_conv.startswith("group:"):
-                rid = self.current_conv.split(":",1)[1]
+            if self._conv_kind == "group":
+                rid = self._conv_target
                 if rid in getattr(self, "closed_rooms", set()):
                     return
         except Exception:
@@ -5861,8 +6044,8 @@ class ChatWindow(QtWidgets.QWidget):
                 name = os.path.basename(path)
                 mime = self._guess_mime(path)
                 try:
-                    if self.current_conv and self.current_conv.startswith("group:"):
-                        rid = self.current_conv.split(":",1)[1]
+                    if self._conv_kind == "group":
+                        rid = self._conv_target
                         self._http_upload_group_file(path, rid, name)
                         self.view.scrollToBottom()
                     else:
@@ -6025,8 +6208,8 @@ class ChatWindow(QtWidgets.QWidget):
                 names = sorted(list(names_set), key=_sort_key)
                 for name in names:
                     self._add_conv_dm(name)
-                if self.current_conv and self.current_conv.startswith("dm:"):
-                    sel = self.current_conv.split(":",1)[1]
+                if self._conv_kind == "dm":
+                    sel = self._conv_target
                     for i in range(self.conv_list.count()):
                         base = self.conv_list.item(i).text().split(" (",1)[0]
                         if base == sel:
@@ -6411,22 +6594,18 @@ class ChatWindow(QtWidgets.QWidget):
             data = base64.b64decode(b64)
             with open(p, "wb") as f:
                 f.write(data)
+            per_user_dir = os.path.join(self.logger.log_dir, user)
             try:
-                per_user_dir = os.path.join(self.logger.log_dir, user)
                 os.makedirs(per_user_dir, exist_ok=True)
-                pu = os.path.join(per_user_dir, filename)
-                with open(pu, "wb") as f2:
-                    f2.write(data)
+                self._mirror_file(p, os.path.join(per_user_dir, filename), data)
             except Exception:
                 pass
             try:
                 ext = ".png" if mime.lower() == "image/png" else (".jpg" if mime.lower() in ("image/jpg", "image/jpeg") else os.path.splitext(filename)[1] or ".png")
                 p_norm = os.path.join(d, f"avatar{ext}")
-                with open(p_norm, "wb") as f3:
-                    f3.write(data)
-                pu_norm = os.path.join(os.path.join(self.logger.log_dir, user), f"avatar{ext}")
-                with open(pu_norm, "wb") as f4:
-                    f4.write(data)
+                self._mirror_file(p, p_norm, data)
+                pu_norm = os.path.join(per_user_dir, f"avatar{ext}")
+                self._mirror_file(p, pu_norm, data)
                 try:
                     _save_profile(self.logger.log_dir, user, f"avatar{ext}")
                 except Exception:
@@ -6437,12 +6616,41 @@ class ChatWindow(QtWidgets.QWidget):
         except Exception:
             return None
 
+    def _mirror_file(self, src: str, dst: str, data: bytes):
+        # copy an already-written file instead of writing the same bytes again;
+        # copyfile uses the kernel fast path (sendfile/fcopyfile) where available.
+        # Not a hardlink: avatar{ext} files get overwritten in place later.
+        if os.path.abspath(src) == os.path.abspath(dst):
+            return
+        try:
+            shutil.copyfile(src, dst)
+        except OSError:
+            with open(dst, "wb") as f:
+                f.write(data)
+
     def _set_online(self, name: str, online: bool):
         if online:
             self.online_users.add(name)
         else:
             self.online_users.discard(name)
-        self._refresh_conv_icon(name)
+        self._queue_icon_refresh(name)
+
+    def _queue_icon_refresh(self, name: str):
+        # presence updates arrive in bursts (USERS sync, reconnect); repaint once per burst
+        self._pending_icon_refresh.add(name)
+        if not self._icon_flush_scheduled:
+            self._icon_flush_scheduled = True
+            QtCore.QTimer.singleShot(0, self._flush_icon_refresh)
+
+    def _flush_icon_refresh(self):
+        names = self._pending_icon_refresh
+        self._pending_icon_refresh = set()
+        self._icon_flush_scheduled = False
+        for name in names:
+            try:
+                self._refresh_conv_icon(name)
+            except Exception:
+                pass
 
     def _base_avatar_pixmap(self, name: str, size: int = 24) -> QtGui.QPixmap:
         if name == self.username and self.avatar_pixmap:
@@ -6460,63 +6668,36 @@ class ChatWindow(QtWidgets.QWidget):
 
     def _status_pixmap_for_name(self, name: str, size: int = 24) -> QtGui.QPixmap:
         base = self._base_avatar_pixmap(name, size)
-        # Check if connected
-        if hasattr(self, "is_connected") and not self.is_connected:
-            return self._desaturate_pixmap(base, size)
-        
-        if name in self.online_users:
+        if getattr(self, "is_connected", True) and name in self.online_users:
             return base
-        return self._desaturate_pixmap(base, size)
-
-    def _desaturate_pixmap(self, pm: QtGui.QPixmap, size: int) -> QtGui.QPixmap:
-        if pm.isNull():
-            return pm
-        img = pm.toImage()
-        if img.format() != QtGui.QImage.Format_ARGB32:
-            img = img.convertToFormat(QtGui.QImage.Format_ARGB32)
-        
-        w = img.width()
-        h = img.height()
-        
-        # Create a new image for the grayscale version to avoid modifying shared data if implicit sharing is used
-        out_img = QtGui.QImage(w, h, QtGui.QImage.Format_ARGB32)
-        out_img.fill(QtCore.Qt.transparent)
-        
-        for y in range(h):
-            for x in range(w):
-                c = img.pixel(x, y)
-                a = (c >> 24) & 0xFF
-                if a == 0:
-                    continue
-                r = (c >> 16) & 0xFF
-                g = (c >> 8) & 0xFF
-                b = c & 0xFF
-                # Standard grayscale conversion
-                gray = int(0.299 * r + 0.587 * g + 0.114 * b)
-                # Reconstruct pixel with original alpha
-                new_c = (a << 24) | (gray << 16) | (gray << 8) | gray
-                out_img.setPixel(x, y, new_c)
-                
-        out = QtGui.QPixmap.fromImage(out_img)
-        return out.scaled(size, size, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation)
+        if base.isNull():
+            return base
+        return QtGui.QPixmap.fromImage(_grayscale_image(base.toImage()))
+
+    def _set_current_conv(self, key: Optional[str]):
+        # keep the parsed ("group"|"dm", target) form next to the raw key so hot
+        # paths don't re-split "group:ROOM" / "dm:USER" on every use
+        self.current_conv = key
+        if key and ":" in key:
+            self._conv_kind, self._conv_target = key.split(":", 1)
+        else:
+            self._conv_kind, self._conv_target = "", ""
 
     def switch_conv(self, key: str):
         self._ensure_conv(key)
-        self.current_conv = key
+        self._set_current_conv(key)
         self.chat_stack.setCurrentIndex(1)
-        if key.startswith("group:"):
+        if self._conv_kind == "group":
             self.dm_target = None
         else:
-            name = key.split(":",1)[1]
-            self.dm_target = name
+            self.dm_target = self._conv_target
         self.current_model = self.conv_models[key]
         self.view.setModel(self.current_model)
         self._reset_unread(key)
         try:
             editable = True
-            if key.startswith("group:"):
-                rid = key.split(":",1)[1]
-                if rid in getattr(self, "closed_rooms", set()):
+            if self._conv_kind == "group":
+                if self._conv_target in getattr(self, "closed_rooms", set()):
                     editable = False
             self.entry.setReadOnly(not editable)
             self.entry.setEnabled(editable)
@@ -6532,45 +6713,128 @@ class ChatWindow(QtWidgets.QWidget):
             pass
         # 不自动发送 READ，避免服务端推送未读/历史
         if len(self.current_model.items) == 0:
-            conv = key
-            missing = 0
-            for sender, ts, kind, text, selfflag in self.store.recent(conv, 100):
+            self._hydrate_conv_async(key)
+        try:
+            QtCore.QTimer.singleShot(0, lambda: self.view.scrollToBottom())
+        except Exception:
+            pass
+
+    def _conv_history_rows(self, key: str, max_id: int, db=None) -> list:
+        # plain dicts only, so this can run on the pool; QPixmaps are built by _on_conv_hydrated
+        rows = []
+        try:
+            for sender, ts, kind, text, selfflag in self.store.recent(key, 100, db, max_id):
+                row = {"sender": sender, "ts": int(ts) if ts else None, "kind": kind, "text": text, "self": bool(selfflag)}
                 if text.startswith("[LINK] "):
                     try:
                         toks = text.split(" ")
-                        url = toks[-1] if len(toks) >= 2 else ""
-                        size = int(toks[-2]) if len(toks) >= 3 else 0
-                        filename = " ".join(toks[1:-2]) if len(toks) >= 3 else (toks[1] if len(toks) > 1 else "")
+                        row["url"] = toks[-1] if len(toks) >= 2 else ""
+                        row["size"] = int(toks[-2]) if len(toks) >= 3 else 0
+                        row["filename"] = " ".join(toks[1:-2]) if len(toks) >= 3 else (toks[1] if len(toks) > 1 else "")
                     except Exception:
-                        filename = ""
-                        url = ""
-                        size = 0
-                    av = self.avatar_pixmap if sender == self.username else self.peer_avatars.get(sender)
-                    self.current_model.add_link(sender, filename, url, bool(selfflag), av, int(ts) if ts else None, size)
-                    continue
-                if kind == "file" and text.startswith("[FILE] "):
+                        row["filename"] = ""
+                        row["url"] = ""
+                        row["size"] = 0
+                    row["kind"] = "link"
+                elif kind == "file" and text.startswith("[FILE] "):
                     fn, mime, _ = self._parse_file(text)
-                    p = self._attachment_path(fn, conv)
-                    pix = QtGui.QPixmap(p) if os.path.isfile(p) else None
-                    av = self.avatar_pixmap if sender == self.username else self.peer_avatars.get(sender)
+                    p = self._attachment_path(fn, key)
+                    row["filename"] = fn
+                    row["mime"] = mime
                     try:
-                        sz = os.path.getsize(p) if os.path.isfile(p) else None
-                    except Exception:
-                        sz = None
-                    self.current_model.add_file(sender, fn, mime, pix if pix and not pix.isNull() else None, bool(selfflag), av, int(ts) if ts else None, sz)
-                    if not (pix and not pix.isNull()):
-                        missing += 1
-                elif kind == "sys":
-                    self.current_model.add("sys", "", text, False, None, int(ts) if ts else None)
-                else:
-                    av = self.avatar_pixmap if sender == self.username else self.peer_avatars.get(sender)
-                    self.current_model.add("msg", sender, text, bool(selfflag), av, int(ts) if ts else None)
-            # 不自动拉取历史，保留空界面
+                        row["size"] = os.path.getsize(p)
+                        row["path"] = p
+                    except OSError:
+                        row["size"] = None
+                        row["path"] = None
+                rows.append(row)
+        except Exception:
+            pass
+        return rows
+
+    def _hydrate_conv_async(self, key: str):
+        # SQL + file stats run on the pool; pixmaps and model inserts stay on the GUI thread.
+        # Tokens are per conversation: switching away must not orphan this conversation's load
+        self._hydrate_token += 1
+        token = self._hydrate_token
+        self._hydrate_pending[key] = token
+        # history is what the store held at the switch; rows stored after this are live
+        # rows and reach the model through the normal add paths
+        max_id = self.store.last_id()
+        m = self.conv_models.get(key)
+        if m is not None:
+            # a live row must not land above the history (upload rows are tracked by row
+            # number), so if one arrives first the history is loaded inline just before it
+            m.before_append = lambda k=key, t=token, hi=max_id: self._hydrate_conv_now(k, t, hi)
+        class _Task(QtCore.QRunnable):
+            def __init__(self, owner, key: str, token: int, max_id: int):
+                super().__init__()
+                self.owner = owner
+                self.key = key
+                self.token = token
+                self.max_id = max_id
+            def run(self):
+                rows = []
+                db = None
+                try:
+                    db = self.owner.store.reader()
+                    rows = self.owner._conv_history_rows(self.key, self.max_id, db)
+                except Exception:
+                    pass
+                finally:
+                    if db is not None:
+                        try:
+                            db.close()
+                        except Exception:
+                            pass
+                QtCore.QTimer.singleShot(0, self.owner, lambda o=self.owner, k=self.key, t=self.token, r=rows: o._on_conv_hydrated(k, t, r))
         try:
-            QtCore.QTimer.singleShot(0, lambda: self.view.scrollToBottom())
+            QtCore.QThreadPool.globalInstance().start(_Task(self, key, token, max_id))
         except Exception:
             pass
 
+    def _av_for_sender(self, sender: str) -> Optional[QtGui.QPixmap]:
+        return self.avatar_pixmap if sender == self.username else self.peer_avatars.get(sender)
+
+    def _hydrate_conv_now(self, key: str, token: int, max_id: int):
+        if self._hydrate_pending.get(key) == token:
+            self._on_conv_hydrated(key, token, self._conv_history_rows(key, max_id), inline=True)
+
+    def _on_conv_hydrated(self, key: str, token: int, rows: list, inline: bool = False):
+        if self._hydrate_pending.get(key) != token:
+            return
+        # consume the token so the pool result (or the inline load) that loses the race is dropped
+        del self._hydrate_pending[key]
+        m = self.conv_models.get(key)
+        if m is None:
+            return
+        if not inline:
+            if m.before_append is None:
+                # the model was cleared while the query ran
+                return
+            m.before_append = None
+        entries = []
+        for r in rows:
+            sender = r["sender"]
+            kind = r["kind"]
+            av = self._av_for_sender(sender)
+            if kind == "link":
+                item = m._file_item(sender, r["filename"], "application/x-download", None, r["self"], av, r["size"], r["url"])
+            elif kind == "file" and "filename" in r:
+                pix = QtGui.QPixmap(r["path"]) if r["path"] else None
+                item = m._file_item(sender, r["filename"], r["mime"], pix if pix and not pix.isNull() else None, r["self"], av, r["size"])
+            elif kind == "sys":
+                item = m._msg_item("sys", "", r["text"], False, None)
+            else:
+                item = m._msg_item("msg", sender, r["text"], r["self"], av)
+            entries.append((r["ts"], item))
+        m.add_batch(entries)
+        if key == self.current_conv:
+            try:
+                self.view.scrollToBottom()
+            except Exception:
+                pass
+
     def on_view_context_menu(self, pos):
         sender = self.sender()
         global_pos = sender.mapToGlobal(pos) if hasattr(sender, 'mapToGlobal') else QtGui.QCursor.pos()
@@ -6643,13 +6907,7 @@ class ChatWindow(QtWidgets.QWidget):
                     if link_url:
                         dst, _ = QtWidgets.QFileDialog.getSaveFileName(self, "另存为", filename or "")
                         if dst:
-                            try:
-                                with urllib.request.urlopen(link_url, timeout=10.0) as resp:
-                                    data = resp.read()
-                                with open(dst, "wb") as f:
-                                    f.write(data)
-                            except Exception:
-                                QtWidgets.QMessageBox.warning(self, "下载失败", "无法下载该文件")
+                            self._download_to_file_async(str(link_url), dst)
                     else:
                         src = self._attachment_path(filename, self.current_conv)
                         if not os.path.isfile(src):
@@ -6709,40 +6967,23 @@ class ChatWindow(QtWidgets.QWidget):
                         # cancel worker
                         w.cancel()
                         # hide pie instantly
+                        self._fading_rows.pop((key, row), None)
                         try:
                             self.current_model.set_upload_progress(row, None, None, "canceled")
                             self.current_model.set_upload_alpha(row, 0)
-                            key2 = (key, row)
-                            t2 = self._fade_timers.get(key2)
-                            if t2:
-                                try:
-                                    t2.stop()
-                                    t2.deleteLater()
-                                except Exception:
-                                    pass
-                                try:
-                                    del self._fade_timers[key2]
-                                except Exception:
-                                    pass
-                            if hasattr(self, "view") and self.view:
-                                self.view.viewport().update()
                         except Exception:
                             pass
                         # remove worker mapping to avoid further UI updates
-                        try:
-                            if (key, row) in self.upload_workers:
-                                del self.upload_workers[(key, row)]
-                        except Exception:
-                            pass
+                        self.upload_workers.pop((key, row), None)
                         # notify peer to cleanup .part
                         try:
                             fname = index.data(ChatModel.FileNameRole) or ""
-                            if self.current_conv and self.current_conv.startswith("dm:"):
-                                target = self.current_conv.split(":",1)[1]
+                            if self._conv_kind == "dm":
+                                target = self._conv_target
                                 if fname:
                                     self._send_seq(f"DM {target} FILE_CANCEL {fname}")
                             else:
-                                rid = (self.current_conv.split(":",1)[1] if self.current_conv and self.current_conv.startswith("group:") else self.room)
+                                rid = (self._conv_target if self._conv_kind == "group" else self.room)
                                 if rid and fname:
                                     self._send_seq(f"MSG FILE_CANCEL {fname}", rid)
                         except Exception:
@@ -6760,12 +7001,39 @@ class ChatWindow(QtWidgets.QWidget):
                     d = self._attachment_dir(self.current_conv)
                     if os.path.isdir(d):
                         shutil.rmtree(d, ignore_errors=True)
+                    self._ensured_att_dirs.discard(d)
                     self.store.mark_cleared(self.current_conv)
                 except Exception:
                     pass
         act_clear.triggered.connect(do_clear)
         menu.exec(global_pos)
 
+    def _download_to_file_async(self, url: str, dst: str):
+        class _Task(QtCore.QRunnable):
+            def __init__(self, owner, url: str, dst: str):
+                super().__init__()
+                self.owner = owner
+                self.url = url
+                self.dst = dst
+            def run(self):
+                # stream straight to disk; never hold the whole file in memory. The bytes go to
+                # a .part file that only takes dst's name once the download has completed
+                part = self.dst + ".part"
+                try:
+                    with urllib.request.urlopen(self.url, timeout=10.0) as resp, open(part, "wb") as f:
+                        shutil.copyfileobj(resp, f, 1 << 20)
+                    os.replace(part, self.dst)
+                except Exception:
+                    try:
+                        os.remove(part)
+                    except OSError:
+                        pass
+                    QtCore.QTimer.singleShot(0, self.owner, lambda o=self.owner: QtWidgets.QMessageBox.warning(o, "下载失败", "无法下载该文件"))
+        try:
+            QtCore.QThreadPool.globalInstance().start(_Task(self, url, dst))
+        except Exception:
+            pass
+
     def _check_remote_file_exists(self, url: str) -> bool:
         if not url.startswith("http"):
             return True
@@ -6830,7 +7098,7 @@ class ChatWindow(QtWidgets.QWidget):
                 idx = self.view.indexAt(ev.position().toPoint())
                 want_ibeam = False
                 if idx.isValid() and idx.data(ChatModel.KindRole) == "msg":
-                    if self._bubble_contains(idx, ev.position().toPoint()):
+                    if self._hit_bubble(idx, ev.position().toPoint())[0]:
                         want_ibeam = True
                 if want_ibeam:
                     self.view.viewport().setCursor(QtGui.QCursor(QtCore.Qt.IBeamCursor))
@@ -6897,14 +7165,14 @@ class ChatWindow(QtWidgets.QWidget):
                     filename = ""
                     url = ""
                     size = 0
-                av = self.avatar_pixmap if sender == self.username else self.peer_avatars.get(sender)
+                av = self._av_for_sender(sender)
                 self.conv_models[f"group:{self.room}"].add_link(sender, filename, url, bool(selfflag), av, int(ts) if ts else None, size)
                 continue
             if kind == "file" and text.startswith("[FILE] "):
                 fn, mime, _ = self._parse_file(text)
                 p = self._attachment_path(fn, f"group:{self.room}")
                 pix = QtGui.QPixmap(p) if os.path.isfile(p) else None
-                av = self.avatar_pixmap if sender == self.username else self.peer_avatars.get(sender)
+                av = self._av_for_sender(sender)
                 try:
                     sz = os.path.getsize(p) if os.path.isfile(p) else None
                 except Exception:
@@ -6915,7 +7183,7 @@ class ChatWindow(QtWidgets.QWidget):
             elif kind == "sys":
                 self.conv_models[f"group:{self.room}"].add("sys", "", text, False, None)
             else:
-                av = self.avatar_pixmap if sender == self.username else self.peer_avatars.get(sender)
+                av = self._av_for_sender(sender)
                 self.conv_models[f"group:{self.room}"].add("msg", sender, text, bool(selfflag), av)
         # if group model empty or some images missing locally, request history to hydrate attachments
         try:
@@ -6930,35 +7198,32 @@ class ChatWindow(QtWidgets.QWidget):
             target_room = rid
             if not target_room:
                 try:
-                    if self.current_conv and self.current_conv.startswith("group:"):
-                        target_room = self.current_conv.split(":",1)[1]
+                    if self._conv_kind == "group":
+                        target_room = self._conv_target
                 except Exception:
                     target_room = None
             if not target_room:
                 target_room = self.room
             payload = f"SEQ {self.seq} {body}\n".encode("utf-8")
-            s = self.socks.get(target_room) if hasattr(self, 'socks') else None
+            s = self.socks.get(target_room) or self.sock
             if s:
                 s.sendall(payload)
-            elif self.sock:
-                self.sock.sendall(payload)
             self.seq += 1
         except Exception:
             pass
 
     def _send_ping(self):
         try:
-            ts = str(QtCore.QDateTime.currentMSecsSinceEpoch())
+            payload = f"PING {QtCore.QDateTime.currentMSecsSinceEpoch()}\n".encode("ascii")
             sent = False
-            if hasattr(self, 'socks'):
-                for rid, s in list(self.socks.items()):
-                    try:
-                        s.sendall((f"PING {ts}\n").encode("utf-8"))
-                        sent = True
-                    except Exception:
-                        pass
+            for s in list(self.socks.values()):
+                try:
+                    s.sendall(payload)
+                    sent = True
+                except Exception:
+                    pass
             if not sent and self.sock:
-                self.sock.sendall((f"PING {ts}\n").encode("utf-8"))
+                self.sock.sendall(payload)
         except Exception:
             pass
     def _restart_room_socket(self, rid: Optional[str] = None):
@@ -7055,11 +7320,11 @@ class ChatWindow(QtWidgets.QWidget):
             mime = self._guess_mime(path)
             rid = None
             uploader = None
-            if self.current_conv and self.current_conv.startswith("dm:"):
-                target = self.current_conv.split(":",1)[1]
+            if self._conv_kind == "dm":
+                target = self._conv_target
                 uploader = MultiConnFileUploader(self.host, self.port, self.username, self.room, "dm", target, path, 2, 1048576, (self.avatar_filename or ""), name, logger=self.logger)
-            elif self.current_conv and self.current_conv.startswith("group:"):
-                rid = self.current_conv.split(":",1)[1]
+            elif self._conv_kind == "group":
+                rid = self._conv_target
                 uploader = MultiConnFileUploader(self.host, self.port, self.username, rid, "group", None, path, 2, 1048576, (self.avatar_filename or ""), name, logger=self.logger)
             else:
                 rid = self.room
@@ -7079,11 +7344,6 @@ class ChatWindow(QtWidgets.QWidget):
                     m.set_upload_progress(row, 0, total, "uploading")
                 except Exception:
                     pass
-                try:
-                    if hasattr(self, "view") and self.view:
-                        self.view.viewport().update()
-                except Exception:
-                    pass
             self.upload_workers[(conv_key, row)] = worker
             def _on_progress(sent, tot):
                 try:
@@ -7097,44 +7357,16 @@ class ChatWindow(QtWidgets.QWidget):
                         else:
                             if (cur_state not in ("fading", "done")) and int(cur_alpha) <= 0:
                                 m.set_upload_progress(row, sent, tot, "fading")
-                                if not hasattr(self, "_fade_timers"):
-                                    self._fade_timers = {}
                                 key = (conv_key, row)
-                                if key not in self._fade_timers:
+                                if key not in self._fading_rows:
                                     m.set_upload_alpha(row, 255)
-                                    t = QtCore.QTimer(self)
-                                    t.setInterval(30)
-                                    def _tick():
-                                        alpha = m.data(m.index(row), ChatModel.UploadAlphaRole) or 0
-                                        na = max(0, int(alpha) - 25)
-                                        m.set_upload_alpha(row, na)
-                                        try:
-                                            if hasattr(self, "view") and self.view:
-                                                self.view.viewport().update()
-                                        except Exception:
-                                            pass
-                                        if na <= 0:
-                                            try:
-                                                m.set_upload_progress(row, None, None, "done")
-                                            except Exception:
-                                                pass
-                                            try:
-                                                t.stop()
-                                                t.deleteLater()
-                                            except Exception:
-                                                pass
-                                            try:
-                                                del self._fade_timers[key]
-                                            except Exception:
-                                                pass
-                                    t.timeout.connect(_tick)
-                                    self._fade_timers[key] = t
-                                    t.start()
-                        try:
-                            if hasattr(self, "view") and self.view:
-                                self.view.viewport().update()
-                        except Exception:
-                            pass
+                                    self._fading_rows[key] = 255
+                                    if self._fade_tick is None:
+                                        self._fade_tick = QtCore.QTimer(self)
+                                        self._fade_tick.setInterval(30)
+                                        self._fade_tick.timeout.connect(self._fade_step)
+                                    if not self._fade_tick.isActive():
+                                        self._fade_tick.start()
                 except Exception:
                     pass
             def _on_finished(ok, err):
@@ -7147,11 +7379,7 @@ class ChatWindow(QtWidgets.QWidget):
                                 m2.add("sys", "", msg, False, None)
                             except Exception:
                                 pass
-                        if (conv_key, row) in self.upload_workers:
-                            try:
-                                del self.upload_workers[(conv_key, row)]
-                            except Exception:
-                                pass
+                        self.upload_workers.pop((conv_key, row), None)
                     else:
                         self.logger.write("sent", self.username, f"[FILE] {name} {mime}")
                         if m and row >= 0:
@@ -7164,11 +7392,7 @@ class ChatWindow(QtWidgets.QWidget):
                             self._copy_attachment_from_path(name, path, conv_key)
                         except Exception:
                             pass
-                        if (conv_key, row) in self.upload_workers:
-                            try:
-                                del self.upload_workers[(conv_key, row)]
-                            except Exception:
-                                pass
+                        self.upload_workers.pop((conv_key, row), None)
                 except Exception:
                     pass
             def _on_pause():
@@ -7183,36 +7407,14 @@ class ChatWindow(QtWidgets.QWidget):
                     worker.cancel()
                     if m and row >= 0:
                         m.set_upload_progress(row, None, None, "canceled")
-                        try:
-                            m.set_upload_alpha(row, 0)
-                        except Exception:
-                            pass
-                        try:
-                            key2 = (conv_key, row)
-                            t2 = self._fade_timers.get(key2)
-                            if t2:
-                                try:
-                                    t2.stop()
-                                    t2.deleteLater()
-                                except Exception:
-                                    pass
-                                try:
-                                    del self._fade_timers[key2]
-                                except Exception:
-                                    pass
-                        except Exception:
-                            pass
-                        try:
-                            if hasattr(self, "view") and self.view:
-                                self.view.viewport().update()
-                        except Exception:
-                            pass
+                        m.set_upload_alpha(row, 0)
+                        self._fading_rows.pop((conv_key, row), None)
                     try:
-                        if self.current_conv and self.current_conv.startswith("dm:"):
-                            target = self.current_conv.split(":",1)[1]
+                        if self._conv_kind == "dm":
+                            target = self._conv_target
                             self._send_seq(f"DM {target} FILE_CANCEL {name}")
                         else:
-                            rid = (self.current_conv.split(":",1)[1] if self.current_conv and self.current_conv.startswith("group:") else self.room)
+                            rid = (self._conv_target if self._conv_kind == "group" else self.room)
                             if rid:
                                 self._send_seq(f"MSG FILE_CANCEL {name}", rid)
                     except Exception:
@@ -7225,31 +7427,116 @@ class ChatWindow(QtWidgets.QWidget):
             worker.start()
         except Exception:
             pass
-    def _http_upload_group_file(self, path: str, rid: str, name: Optional[str] = None):
+    def _fade_step(self):
+        # one timer drives every finished upload's pie fade-out
+        for key, alpha in list(self._fading_rows.items()):
+            conv_key, row = key
+            m = self.conv_models.get(conv_key)
+            na = max(0, alpha - 25)
+            if m:
+                m.set_upload_alpha(row, na)
+            if na <= 0 or not m:
+                del self._fading_rows[key]
+                if m:
+                    m.set_upload_progress(row, None, None, "done")
+            else:
+                self._fading_rows[key] = na
+        if not self._fading_rows:
+            self._fade_tick.stop()
+
+    HTTP_POOL_MAX = 4
+
+    def _http_conn_idle(self, conn) -> bool:
+        # an idle keep-alive socket has nothing to read; readable means the server closed it
+        # (or sent something unexpected), so it must not carry another request
+        sock = conn.sock
+        if sock is None:
+            return False
         try:
-            url = f"http://{self.host}:34568/api/upload_file"
-            boundary = "----XiaoCaiBoundary" + str(int(QtCore.QDateTime.currentMSecsSinceEpoch()))
-            parts = []
-            def _p(s: str):
-                return s.encode("utf-8")
-            parts.append(_p(f"--{boundary}\r\nContent-Disposition: form-data; name=\"room\"\r\n\r\n{rid}\r\n"))
-            parts.append(_p(f"--{boundary}\r\nContent-Disposition: form-data; name=\"sender\"\r\n\r\n{self.username}\r\n"))
-            fname = name or os.path.basename(path)
-            parts.append(_p(f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{fname}\"\r\nContent-Type: application/octet-stream\r\n\r\n"))
-            data = b""
-            try:
-                with open(path, "rb") as f:
-                    data = f.read()
-            except Exception:
-                data = b""
-            parts.append(data)
-            parts.append(_p("\r\n"))
-            parts.append(_p(f"--{boundary}--\r\n"))
-            body = b"".join(parts)
-            req = urllib.request.Request(url, data=body, headers={"Content-Type": f"multipart/form-data; boundary={boundary}", "Content-Length": str(len(body))}, method="POST")
-            try:
-                with urllib.request.urlopen(req, timeout=10.0) as resp:
-                    raw = resp.read()
+            r, _, _ = select.select([sock], [], [], 0)
+        except Exception:
+            return False
+        return not r
+
+    def _http_post(self, path: str, body, headers: dict) -> bytes:
+        # reuse idle keep-alive connections to the file server. A POST is never replayed:
+        # once any of the request may have reached the server a retry could duplicate the
+        # upload, so a pooled connection is checked before use instead, and dead ones are
+        # swapped for a fresh connection before anything is written
+        conn = None
+        with self._http_pool_lock:
+            while self._http_pool and conn is None:
+                c = self._http_pool.pop()
+                if self._http_conn_idle(c):
+                    conn = c
+                else:
+                    c.close()
+        if conn is None:
+            conn = http.client.HTTPConnection(self.host, 34568, timeout=10.0)
+        try:
+            if callable(body):
+                # a callable body writes itself onto the open connection after the headers
+                conn.putrequest("POST", path)
+                for k, v in headers.items():
+                    conn.putheader(k, v)
+                conn.endheaders()
+                body(conn)
+            else:
+                conn.request("POST", path, body=body, headers=headers)
+            resp = conn.getresponse()
+            raw = resp.read()
+        except Exception:
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+            return raw
+        with self._http_pool_lock:
+            if len(self._http_pool) < self.HTTP_POOL_MAX:
+                self._http_pool.append(conn)
+            else:
+                conn.close()
+        return raw
+
+    # multipart pieces for /api/upload_file, pre-encoded; only boundary and values are spliced in
+    _MP_FIELD_TMPL = b'--%b\r\nContent-Disposition: form-data; name="%b"\r\n\r\n%b\r\n'
+    _MP_FILE_TMPL = b'--%b\r\nContent-Disposition: form-data; name="file"; filename="%b"\r\nContent-Type: application/octet-stream\r\n\r\n'
+    _MP_TAIL_TMPL = b'\r\n--%b--\r\n'
+
+    def _http_upload_group_file(self, path: str, rid: str, name: Optional[str] = None):
+        class _Task(QtCore.QRunnable):
+            def __init__(self, owner, path: str, rid: str, fname: str, sender: str):
+                super().__init__()
+                self.owner = owner
+                self.path = path
+                self.rid = rid
+                self.fname = fname
+                self.sender = sender
+            def run(self):
+                try:
+                    path = self.path
+                    fname = self.fname
+                    o = self.owner
+                    boundary = b"----XiaoCaiBoundary" + secrets.token_hex(16).encode("ascii")
+                    head = (o._MP_FIELD_TMPL % (boundary, b"room", self.rid.encode("utf-8"))
+                            + o._MP_FIELD_TMPL % (boundary, b"sender", self.sender.encode("utf-8"))
+                            + o._MP_FILE_TMPL % (boundary, fname.encode("utf-8")))
+                    tail = o._MP_TAIL_TMPL % boundary
+                    try:
+                        size = os.path.getsize(path)
+                    except Exception:
+                        size = 0
+                    def _body(conn):
+                        # the file goes kernel-to-socket via sendfile (socket.sendfile falls back
+                        # to plain sends where the OS has none); never more than `size` bytes so
+                        # Content-Length stays honest
+                        conn.send(head)
+                        if size:
+                            with open(path, "rb") as f:
+                                conn.sock.sendfile(f, 0, size)
+                        conn.send(tail)
+                    headers = {"Content-Type": "multipart/form-data; boundary=" + boundary.decode("ascii"), "Content-Length": str(len(head) + size + len(tail))}
+                    raw = self.owner._http_post("/api/upload_file", _body, headers)
                     try:
                         info = json.loads(raw.decode("utf-8"))
                     except Exception:
@@ -7257,62 +7544,56 @@ class ChatWindow(QtWidgets.QWidget):
                     try:
                         link_url = info.get("url") or ""
                         fname2 = info.get("file_name") or fname
-                        fsize = int(info.get("size") or (len(data) if isinstance(data, (bytes, bytearray)) else 0))
+                        fsize = int(info.get("size") or size)
                     except Exception:
                         link_url = ""
                         fname2 = fname
-                        try:
-                            fsize = len(data) if isinstance(data, (bytes, bytearray)) else 0
-                        except Exception:
-                            fsize = 0
+                        fsize = size
                     if link_url:
-                        try:
-                            key = f"group:{rid}"
-                            self._ensure_conv(key)
-                            av = self.avatar_pixmap
-                            m = self.conv_models.get(key)
-                            if m:
-                                try:
-                                    for idx in range(len(m.items) - 1, -1, -1):
-                                        it = m.items[idx]
-                                        if it.get("kind") == "file" and it.get("sender") == self.username and it.get("filename") == fname2 and not it.get("link_url"):
-                                            m.remove_row(idx)
-                                            break
-                                except Exception:
-                                    pass
-                                m.add_link(self.username, fname2, link_url, True, av, None, fsize)
-                            try:
-                                self.store.add(key, self.username, f"[LINK] {fname2} {fsize} {link_url}", "file", True)
-                            except Exception:
-                                pass
-                            try:
-                                if self.current_conv == key:
-                                    self.view.scrollToBottom()
-                            except Exception:
-                                pass
-                        except Exception:
-                            pass
+                        QtCore.QTimer.singleShot(0, self.owner, lambda o=self.owner, r=self.rid, n=fname2, u=link_url, z=fsize: o._on_http_upload_done(r, n, u, z))
+                except Exception:
+                    pass
+        try:
+            fname = name or os.path.basename(path)
+            QtCore.QThreadPool.globalInstance().start(_Task(self, path, rid, fname, self.username))
+        except Exception:
+            pass
+
+    def _on_http_upload_done(self, rid: str, fname2: str, link_url: str, fsize: int):
+        try:
+            key = f"group:{rid}"
+            self._ensure_conv(key)
+            av = self.avatar_pixmap
+            m = self.conv_models.get(key)
+            if m:
+                try:
+                    for idx in range(len(m.items) - 1, -1, -1):
+                        it = m.items[idx]
+                        if it.get("kind") == "file" and it.get("sender") == self.username and it.get("filename") == fname2 and not it.get("link_url"):
+                            m.remove_row(idx)
+                            break
+                except Exception:
+                    pass
+                m.add_link(self.username, fname2, link_url, True, av, None, fsize)
+            try:
+                self.store.add(key, self.username, f"[LINK] {fname2} {fsize} {link_url}", "file", True)
+            except Exception:
+                pass
+            try:
+                if self.current_conv == key:
+                    self.view.scrollToBottom()
             except Exception:
                 pass
         except Exception:
             pass
 
     def _guess_mime(self, path: str) -> str:
-        ext = os.path.splitext(path)[1].lower()
-        if ext in [".png"]:
-            return "image/png"
-        if ext in [".jpg", ".jpeg"]:
-            return "image/jpeg"
-        if ext in [".gif"]:
-            return "image/gif"
-        if ext in [".txt"]:
-            return "text/plain"
-        return "application/octet-stream"
+        return _EXT_MIME.get(os.path.splitext(path)[1].lower(), "application/octet-stream")
 
     def _pix_from_b64(self, mime: str, b64: str) -> Optional[QtGui.QPixmap]:
         if mime.startswith("image/"):
             try:
-                data = base64.b64decode(b64)
+                data = binascii.a2b_base64(b64)
                 img = QtGui.QImage()
                 img.loadFromData(data)
                 return QtGui.QPixmap.fromImage(img)
@@ -7327,12 +7608,7 @@ class ChatWindow(QtWidgets.QWidget):
             i = 2
             candidate = name
             while True:
-                exists_in_model = False
-                if m:
-                    for it in m.items:
-                        if it.get("kind") == "file" and it.get("sender") == sender and it.get("filename") == candidate:
-                            exists_in_model = True
-                            break
+                exists_in_model = m is not None and (sender, candidate) in m.file_names
                 exists_on_disk = os.path.isfile(os.path.join(att_dir, candidate))
                 if not exists_in_model and not exists_on_disk:
                     return candidate
@@ -7356,7 +7632,7 @@ class ChatWindow(QtWidgets.QWidget):
                 self._rebuild_conv_list()
             except Exception:
                 pass
-            self.current_conv = None
+            self._set_current_conv(None)
             self.current_model = None
             self.chat_stack.setCurrentIndex(0)
             self.conv_list.setFocus()
@@ -7402,17 +7678,17 @@ class ChatWindow(QtWidgets.QWidget):
                     rooms.append({"id": rid, "name": self.room_name_map.get(rid, rid), "_closed": True})
         except Exception:
             pass
+        # collect existing keys once instead of rescanning the list for every room
+        existing = set()
+        for i in range(self.conv_list.count()):
+            it0 = self.conv_list.item(i)
+            if it0:
+                existing.add(it0.data(QtCore.Qt.UserRole))
         for r in rooms:
             rid = str(r.get("id"))
             title = str(r.get("name") or rid)
-            exists = False
-            for i in range(self.conv_list.count()):
-                it0 = self.conv_list.item(i)
-                data0 = it0.data(QtCore.Qt.UserRole) if it0 else None
-                if data0 == f"group:{rid}":
-                    exists = True
-                    break
-            if not exists:
+            if f"group:{rid}" not in existing:
+                existing.add(f"group:{rid}")
                 it = QtWidgets.QListWidgetItem(title)
                 it.setSizeHint(QtCore.QSize(200, 56))
                 try:
@@ -7493,7 +7769,7 @@ class ChatWindow(QtWidgets.QWidget):
                 self._rebuild_conv_list()
             except Exception:
                 pass
-            self.current_conv = None
+            self._set_current_conv(None)
             self.current_model = None
             self.chat_stack.setCurrentIndex(0)
             self.conv_list.setFocus()
@@ -7716,21 +7992,17 @@ class ChatWindow(QtWidgets.QWidget):
         s = msg.strip()
         if not s.startswith("[FILE] "):
             return "file", "application/octet-stream", ""
-        tokens = s.split(" ")
-        if len(tokens) < 3:
-            return "file", "application/octet-stream", ""
-        
-        # Check if second to last token looks like a mime type (contains '/')
+        # peel tokens off the right instead of splitting the whole (possibly long) name
         # Case A: [FILE] name... mime b64 (Network msg or Sent msg in store)
         # Case B: [FILE] name... mime (Received msg in store)
-        if len(tokens) >= 4 and "/" in tokens[-2]:
-             mime = tokens[-2]
-             b64 = tokens[-1]
-             name = " ".join(tokens[1:-2])
+        head, sep, last = s[7:].rpartition(" ")
+        if not sep:
+            return "file", "application/octet-stream", ""
+        head2, sep2, maybe_mime = head.rpartition(" ")
+        if sep2 and "/" in maybe_mime:
+            name, mime, b64 = head2, maybe_mime, last
         else:
-             mime = tokens[-1]
-             b64 = ""
-             name = " ".join(tokens[1:-1])
+            name, mime, b64 = head, last, ""
         return name, mime, b64
 
     def _is_deleted(self, conv_key: str, kind: str, name_or_text: str, mime: Optional[str]) -> bool:
@@ -7744,11 +8016,7 @@ class ChatWindow(QtWidgets.QWidget):
             return False
 
     def _extract_first_image_from_editor(self) -> Optional[bytes]:
-        try:
-            doc: QtGui.QTextDocument = self.entry.document()
-            it = QtGui.QTextDocument.Iterator(doc)
-        except Exception:
-            pass
+        doc: QtGui.QTextDocument = self.entry.document()
 
         # Get quote range to skip
         quote_range = None
@@ -7756,27 +8024,28 @@ class ChatWindow(QtWidgets.QWidget):
             quote_range = self.entry.get_quote_range()
 
         try:
-            cursor = QtGui.QTextCursor(doc)
-            cursor.movePosition(QtGui.QTextCursor.Start)
-            while not cursor.atEnd():
-                # Check if cursor is in quote range and skip it
-                if quote_range:
-                    pos = cursor.position()
-                    if quote_range[0] <= pos < quote_range[1]:
-                        cursor.setPosition(quote_range[1])
+            # walk format runs (fragments) rather than single characters
+            block = doc.firstBlock()
+            while block.isValid():
+                it = block.begin()
+                while not it.atEnd():
+                    frag = it.fragment()
+                    it += 1
+                    if not frag.isValid():
                         continue
-
-                fmt = cursor.charFormat()
-                if fmt.isImageFormat():
-                    imgfmt = QtGui.QTextImageFormat(fmt)
-                    url = QtCore.QUrl(imgfmt.name())
-                    res = doc.resource(QtGui.QTextDocument.ImageResource, url)
-                    if isinstance(res, QtGui.QImage) and not res.isNull():
-                        buf = QtCore.QBuffer()
-                        buf.open(QtCore.QIODevice.WriteOnly)
-                        res.save(buf, "PNG")
-                        return bytes(buf.data())
-                cursor.movePosition(QtGui.QTextCursor.NextCharacter)
+                    if quote_range and quote_range[0] <= frag.position() < quote_range[1]:
+                        continue
+                    fmt = frag.charFormat()
+                    if fmt.isImageFormat():
+                        imgfmt = QtGui.QTextImageFormat(fmt)
+                        url = QtCore.QUrl(imgfmt.name())
+                        res = doc.resource(QtGui.QTextDocument.ImageResource, url)
+                        if isinstance(res, QtGui.QImage) and not res.isNull():
+                            buf = QtCore.QBuffer()
+                            buf.open(QtCore.QIODevice.WriteOnly)
+                            res.save(buf, "PNG")
+                            return bytes(buf.data())
+                block = block.next()
             # fallback: parse html data uri
             html = self.entry.toHtml()
             if "data:image" in html and "base64," in html:
@@ -7808,26 +8077,24 @@ class ChatWindow(QtWidgets.QWidget):
 
     def _sanitize_text(self, s: str) -> str:
         try:
-            t = (s or "")
-            # remove object replacement chars used for embedded images
-            t = t.replace("\uFFFC", "")
-            # remove zero-width spaces
-            t = t.replace("\u200b", "").replace("\u200c", "").replace("\u200d", "")
+            # drop embedded-image placeholders and zero-width chars in one pass
+            t = (s or "").translate(_STRIP_CHARS)
             t = t.replace("\\n", "\n")
             t = t.strip()
             return t
         except Exception:
             return s or ""
 
+    _SIZE_UNITS = ("B", "KB", "MB", "GB", "TB")
+
     def _human_readable_size(self, n: int) -> str:
         try:
-            units = ["B", "KB", "MB", "GB", "TB"]
-            i = 0
-            f = float(max(0, int(n)))
-            while f >= 1024.0 and i < len(units) - 1:
-                f /= 1024.0
-                i += 1
-            return ("{:.1f}{}".format(f, units[i]) if i > 0 else "{}{}".format(int(f), units[i]))
+            n = max(0, int(n))
+            if n < 1024:
+                return "{}B".format(n)
+            # the power of 1024 is just bit_length / 10; no division loop
+            i = min(4, (n.bit_length() - 1) // 10)
+            return "{:.1f}{}".format(n / (1 << (10 * i)), self._SIZE_UNITS[i])
         except Exception:
             return "0B"
 
@@ -7835,32 +8102,33 @@ class ChatWindow(QtWidgets.QWidget):
         if not path or not os.path.isfile(path):
             return
         try:
-            with open(path, "rb") as f:
-                data = f.read()
             name = os.path.basename(path)
             mime = self._guess_mime(path)
-            b64 = base64.b64encode(data).decode("ascii")
-            pix = QtGui.QPixmap(path)
-            self._save_attachment(name, b64, conv_key)
+            size = os.path.getsize(path)
+            # only images are read into memory, for the preview
+            pix = None
+            if mime.startswith("image/"):
+                with open(path, "rb") as f:
+                    data = f.read()
+                pix = QtGui.QPixmap()
+                if not pix.loadFromData(data):
+                    pix = None
+            self._copy_attachment_from_path(name, path, conv_key)
             self._ensure_conv(conv_key)
-            av = self.avatar_pixmap if sender == self.username else self.peer_avatars.get(sender)
-            self.conv_models[conv_key].add_file(sender, name, mime, pix if not pix.isNull() else None, is_self, av, None, len(data))
+            av = self._av_for_sender(sender)
+            self.conv_models[conv_key].add_file(sender, name, mime, pix, is_self, av, None, size)
             self.store.add(conv_key, sender, f"[FILE] {name} {mime}", "file", is_self)
         except Exception:
             pass
 
     def _save_attachment(self, filename: str, b64: str, conv_key: Optional[str] = None):
-        att_dir = self._attachment_dir(conv_key)
-        os.makedirs(att_dir, exist_ok=True)
+        att_dir = self._ensure_att_dir(conv_key)
         try:
-            data = base64.b64decode(b64)
-            with open(os.path.join(att_dir, filename), "wb") as f:
-                f.write(data)
+            _write_b64(os.path.join(att_dir, filename), b64)
         except Exception:
             pass
     def _save_attachment_async(self, filename: str, b64: str, conv_key: Optional[str] = None):
-        att_dir = self._attachment_dir(conv_key)
-        os.makedirs(att_dir, exist_ok=True)
+        att_dir = self._ensure_att_dir(conv_key)
         class _Task(QtCore.QRunnable):
             def __init__(self, owner, dirp: str, fname: str, payload: str):
                 super().__init__()
@@ -7870,12 +8138,10 @@ class ChatWindow(QtWidgets.QWidget):
                 self.payload = payload
             def run(self):
                 try:
-                    data = base64.b64decode(self.payload)
-                    with open(os.path.join(self.dirp, self.fname), "wb") as f:
-                        f.write(data)
+                    size = _write_b64(os.path.join(self.dirp, self.fname), self.payload)
                     try:
                         if hasattr(self.owner, "logger") and self.owner.logger:
-                            self.owner.logger.write("recv", self.owner.username, f"FILE_SAVE path={os.path.join(self.dirp, self.fname)} size={len(data)}")
+                            self.owner.logger.write("recv", self.owner.username, f"FILE_SAVE path={os.path.join(self.dirp, self.fname)} size={size}")
                     except Exception:
                         pass
                 except Exception:
@@ -7885,167 +8151,217 @@ class ChatWindow(QtWidgets.QWidget):
         except Exception:
             pass
     def _copy_attachment_from_path(self, filename: str, src_path: str, conv_key: Optional[str] = None):
-        att_dir = self._attachment_dir(conv_key)
-        os.makedirs(att_dir, exist_ok=True)
+        att_dir = self._ensure_att_dir(conv_key)
+        class _Task(QtCore.QRunnable):
+            def __init__(self, src: str, dst: str):
+                super().__init__()
+                self.src = src
+                self.dst = dst
+            def run(self):
+                try:
+                    # copyfile picks the platform fast path (sendfile / fcopyfile)
+                    if os.path.abspath(self.src) != os.path.abspath(self.dst):
+                        shutil.copyfile(self.src, self.dst)
+                except Exception:
+                    pass
         try:
-            dst = os.path.join(att_dir, filename)
-            shutil.copyfile(src_path, dst)
+            QtCore.QThreadPool.globalInstance().start(_Task(src_path, os.path.join(att_dir, filename)))
         except Exception:
             pass
     def _delete_part_globally(self, filename: str):
         try:
+            # close any open part files first so the unlink below also works on Windows
+            for k in list(self._rx_files.keys()):
+                if k and len(k) >= 3 and k[2] == filename:
+                    self._rx_drop(k)
             base = self._attachment_dir(None)
-            for entry in os.listdir(base):
-                partp = os.path.join(base, entry, filename + ".part")
-                if os.path.isfile(partp):
+            # scandir already knows which entries are directories; just try the remove
+            with os.scandir(base) as entries:
+                for entry in entries:
+                    if not entry.is_dir(follow_symlinks=False):
+                        continue
                     try:
-                        os.remove(partp)
+                        os.remove(os.path.join(entry.path, filename + ".part"))
                     except Exception:
                         pass
-            try:
-                for k in list(self._rx_files.keys()):
-                    if k and len(k) >= 3 and k[2] == filename:
-                        try:
-                            del self._rx_files[k]
-                        except Exception:
-                            pass
-            except Exception:
-                pass
         except Exception:
             pass
+    def _rx_route(self, meta: dict, conv_key: str):
+        # ("dm", None) / ("group", rid) / (None, None); parsed once per transfer, not per chunk
+        route = meta.get("route")
+        if route is None:
+            if conv_key.startswith("dm:"):
+                route = ("dm", None)
+            elif conv_key.startswith("group:"):
+                route = ("group", conv_key.split(":", 1)[1])
+            else:
+                route = (None, None)
+            meta["route"] = route
+        return route
+    def _rx_drop(self, key: tuple):
+        self._rx_close_fd(self._rx_files.pop(key, None), final=True)
+    def _rx_close_fd(self, meta: Optional[dict], final: bool = False):
+        # final: the transfer is gone, so late chunk writes must not reopen the part file
+        if not meta:
+            return
+        with meta.setdefault("lock", threading.Lock()):
+            fd = meta.pop("fd", None)
+            if final:
+                meta["closed"] = True
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except Exception:
+                    pass
+    def _rx_flush(self, meta: dict, path: str, total: int):
+        # writes everything queued in meta["pending"], merging adjacent ranges into one
+        # pwritev. Returns (file size, [(off, len)] written by this call) or (None, []).
+        # One descriptor per transfer, kept in its _rx_files entry and opened on first use;
+        # the lock keeps a concurrent close from pulling the fd out from under a write.
+        pending = meta.get("pending")
+        with meta.setdefault("lock", threading.Lock()):
+            items = []
+            while pending:
+                try:
+                    items.append(pending.popleft())
+                except IndexError:
+                    break
+            if not items:
+                return None, []
+            if meta.get("closed"):
+                raise FileNotFoundError(path)
+            fd = meta.get("fd")
+            if fd is None:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+                meta["fd"] = fd
+            items.sort(key=lambda t: t[0])
+            runs = []
+            for off, data in items:
+                if runs and runs[-1][0] + runs[-1][1] == off:
+                    runs[-1][1] += len(data)
+                    runs[-1][2].append(data)
+                else:
+                    runs.append([off, len(data), [data]])
+            for off, ln, bufs in runs:
+                n = 0
+                if len(bufs) > 1 and hasattr(os, "pwritev"):
+                    n = os.pwritev(fd, bufs, off)
+                if n < ln:
+                    view = memoryview(b"".join(bufs) if len(bufs) > 1 else bufs[0])[n:]
+                    pos = off + n
+                    while view:
+                        if hasattr(os, "pwrite"):
+                            k = os.pwrite(fd, view, pos)
+                        else:
+                            os.lseek(fd, pos, os.SEEK_SET)
+                            k = os.write(fd, view)
+                        view = view[k:]
+                        pos += k
+            sz = os.fstat(fd).st_size
+            if total > 0 and sz >= total:
+                # one flush to disk when the file is complete, before it is
+                # moved into place; missing ranges are re-sent via FILE_HAVE
+                try:
+                    os.fsync(fd)
+                except Exception:
+                    pass
+            return sz, [(off, len(data)) for off, data in items]
+    RX_FLUSH_CHUNKS = 16
+    RX_WATCHDOG_MS = 5000
+
     def _rx_write_chunk_async(self, conv_key: str, sender: str, filename: str, part_path: str, total: int, offset: int, b64: str):
+        # chunks land in the transfer's inbox; at most one pool task per transfer drains it,
+        # so a burst of chunks costs one task instead of one QRunnable each
+        key = (conv_key, sender, filename)
+        meta = self._rx_files.get(key)
+        if meta is None:
+            return
+        inbox = meta.setdefault("inbox", collections.deque())
+        inbox.append((int(max(0, offset)), b64))
+        with meta.setdefault("qlock", threading.Lock()):
+            if meta.get("draining"):
+                return
+            meta["draining"] = True
         class _Task(QtCore.QRunnable):
-            def __init__(self, owner, conv_key: str, sender: str, filename: str, path: str, total: int, off: int, payload: str):
+            def __init__(self, owner, key: tuple, meta: dict, path: str, total: int):
                 super().__init__()
                 self.owner = owner
-                self.conv_key = conv_key
-                self.sender = sender
-                self.filename = filename
+                self.key = key
+                self.meta = meta
                 self.path = path
                 self.total = int(max(0, total))
-                self.off = int(max(0, off))
-                self.payload = payload
             def run(self):
-                try:
-                    key = (self.conv_key, self.sender, self.filename)
+                inbox = self.meta["inbox"]
+                while True:
                     try:
-                        if (hasattr(self.owner, "_rx_files") and key not in self.owner._rx_files):
-                            return
+                        self._drain(inbox)
                     except Exception:
                         pass
-                    try:
-                        d0 = self.owner._rx_files.get(key) or {}
-                        chunks0 = d0.get("chunks")
-                        if isinstance(chunks0, dict) and (self.off in chunks0) and chunks0.get(self.off, 0) > 0:
-                            md5_0 = d0.get("md5")
-                            wrote_0 = int(max(0, chunks0.get(self.off, 0)))
-                            if md5_0:
-                                if self.conv_key.startswith("dm:"):
-                                    peer0 = self.sender
-                                    try:
-                                        self.owner._send_seq(f"DM {peer0} FILE_ACK {md5_0} {int(max(0,self.off))} {wrote_0}")
-                                    except Exception:
-                                        pass
-                                elif self.conv_key.startswith("group:"):
-                                    try:
-                                        rid0 = self.conv_key.split(":",1)[1]
-                                        self.owner._send_seq(f"MSG FILE_ACK {md5_0} {int(max(0,self.off))} {wrote_0}", rid0)
-                                    except Exception:
-                                        pass
+                    with self.meta["qlock"]:
+                        if not inbox:
+                            self.meta["draining"] = False
                             return
-                    except Exception:
-                        pass
-                    data = None
-                    try:
-                        data = base64.b64decode(self.payload)
-                    except Exception:
-                        try:
-                            data = base64.b64decode(self.payload.encode("ascii"), validate=False)
-                        except Exception:
-                            data = b""
-                    if not isinstance(data, (bytes, bytearray)):
-                        data = b""
+            def _drain(self, inbox):
+                conv_key, sender, filename = self.key
+                meta = self.meta
+                if self.owner._rx_files.get(self.key) is not meta:
+                    # cancelled or restarted: nothing queued here belongs on disk any more
+                    inbox.clear()
+                    return
+                chunks = meta.get("chunks")
+                if not isinstance(chunks, dict):
+                    chunks = None
+                md5 = meta.get("md5")
+                kind, rid = self.owner._rx_route(meta, conv_key)
+                def _ack(off: int, wrote: int):
                     try:
-                        if not os.path.isfile(self.path):
-                            with open(self.path, "wb") as _f:
-                                _f.write(b"")
+                        if kind == "dm":
+                            self.owner._send_seq(f"DM {sender} FILE_ACK {md5} {off} {wrote}")
+                        elif kind == "group":
+                            self.owner._send_seq(f"MSG FILE_ACK {md5} {off} {wrote}", rid)
                     except Exception:
                         pass
-                    mode = "r+b"
-                    try:
-                        cur_sz = os.path.getsize(self.path) if os.path.isfile(self.path) else 0
-                    except Exception:
-                        cur_sz = 0
-                    try:
-                        if self.off == cur_sz:
-                            mode = "ab"
-                    except Exception:
-                        mode = "r+b"
-                    with open(self.path, mode) as f:
-                        if mode != "ab":
-                            try:
-                                f.seek(self.off)
-                            except Exception:
-                                f.seek(0, os.SEEK_END)
-                        f.write(data)
-                        try:
-                            f.flush()
-                        except Exception:
-                            pass
-                        try:
-                            os.fsync(f.fileno())
-                        except Exception:
-                            pass
+                pending = meta.setdefault("pending", collections.deque())
+                # decode a bounded batch so a long backlog never sits in memory decoded
+                for _ in range(self.owner.RX_FLUSH_CHUNKS):
                     try:
-                        d = self.owner._rx_files.get(key) or {}
-                        chunks = d.get("chunks")
-                        if isinstance(chunks, dict):
-                            chunks[self.off] = len(data)
-                    except Exception:
-                        pass
+                        off, payload = inbox.popleft()
+                    except IndexError:
+                        break
+                    if chunks is not None and chunks.get(off, 0) > 0:
+                        # duplicate chunk: already on disk, just re-ack it
+                        if md5:
+                            _ack(off, int(max(0, chunks[off])))
+                        continue
                     try:
-                        d = self.owner._rx_files.get(key) or {}
-                        md5 = d.get("md5")
-                        wrote = len(data)
-                        if md5 and wrote > 0:
-                            if self.conv_key.startswith("dm:"):
-                                peer = self.sender
-                                try:
-                                    self.owner._send_seq(f"DM {peer} FILE_ACK {md5} {int(max(0,self.off))} {int(max(0,wrote))}")
-                                except Exception:
-                                    pass
-                            elif self.conv_key.startswith("group:"):
-                                try:
-                                    rid = self.conv_key.split(":",1)[1]
-                                    self.owner._send_seq(f"MSG FILE_ACK {md5} {int(max(0,self.off))} {int(max(0,wrote))}", rid)
-                                except Exception:
-                                    pass
+                        # a2b_base64 takes the ASCII str as-is; no b64decode wrapper or re-encode
+                        data = binascii.a2b_base64(payload)
                     except Exception:
-                        pass
+                        data = b""
+                    pending.append((off, data))
+                sz, written = self.owner._rx_flush(meta, self.path, self.total)
+                if not written:
+                    return
+                # the transfer may have been cancelled or restarted while writing
+                live = self.owner._rx_files.get(self.key) is meta
+                for off, n in written:
+                    if live:
+                        if chunks is not None:
+                            chunks[off] = n
+                        if md5 and n:
+                            _ack(off, n)
                     try:
                         if hasattr(self.owner, "logger") and self.owner.logger:
-                            self.owner.logger.write("recv", self.sender, f"FILE_CHUNK_WRITE part={self.path} off={int(max(0,self.off))} wrote={len(data)}")
-                    except Exception:
-                        pass
-                    try:
-                        if self.total > 0:
-                            try:
-                                sz = os.path.getsize(self.path)
-                            except Exception:
-                                sz = 0
-                            if sz >= self.total:
-                                # Ensure UI updates happen on main thread
-                                QtCore.QTimer.singleShot(0, self.owner, lambda o=self.owner, k=self.conv_key, s=self.sender, f=self.filename: o._rx_file_end(k, s, f))
+                            self.owner.logger.write("recv", sender, f"FILE_CHUNK_WRITE part={self.path} off={off} wrote={n}")
                     except Exception:
                         pass
-                except FileNotFoundError:
-                    return
-                except Exception:
-                    pass
+                if self.total > 0 and sz >= self.total:
+                    # Ensure UI updates happen on main thread
+                    QtCore.QTimer.singleShot(0, self.owner, lambda o=self.owner, k=conv_key, s=sender, f=filename: o._rx_file_end(k, s, f))
         try:
-            QtCore.QThreadPool.globalInstance().start(_Task(self, conv_key, sender, filename, part_path, int(max(0,total)), offset, b64))
+            QtCore.QThreadPool.globalInstance().start(_Task(self, key, meta, part_path, int(max(0,total))))
         except Exception:
-            pass
+            meta["draining"] = False
 
     def _attachment_dir(self, conv_key: Optional[str] = None) -> str:
         base = os.path.join(self.store.root, "attachments")
@@ -8058,6 +8374,14 @@ class ChatWindow(QtWidgets.QWidget):
         )
         return os.path.join(base, safe)
 
+    def _ensure_att_dir(self, conv_key: Optional[str] = None) -> str:
+        # mkdir once per directory per session instead of once per saved file
+        d = self._attachment_dir(conv_key)
+        if d not in self._ensured_att_dirs:
+            os.makedirs(d, exist_ok=True)
+            self._ensured_att_dirs.add(d)
+        return d
+
     def _attachment_path(self, filename: str, conv_hint: Optional[str] = None) -> str:
         # try conv-specific path first
         if conv_hint:
@@ -8073,26 +8397,33 @@ class ChatWindow(QtWidgets.QWidget):
         p = os.path.join(self._attachment_dir(None), filename)
         if os.path.isfile(p):
             return p
-        # search subfolders
+        # search subfolders; remember where a name was found so the next lookup is one stat
+        cand = self._att_search_cache.get(filename)
+        if cand and os.path.isfile(cand):
+            return cand
         try:
             base = self._attachment_dir(None)
-            for entry in os.listdir(base):
-                cand = os.path.join(base, entry, filename)
-                if os.path.isfile(cand):
-                    return cand
+            with os.scandir(base) as entries:
+                for entry in entries:
+                    if not entry.is_dir(follow_symlinks=False):
+                        continue
+                    cand = os.path.join(entry.path, filename)
+                    if os.path.isfile(cand):
+                        self._att_search_cache[filename] = cand
+                        return cand
         except Exception:
             pass
         return p
     def _rx_file_begin(self, conv_key: str, sender: str, filename: str, mime: str, total: int):
-        att_dir = self._attachment_dir(conv_key)
-        os.makedirs(att_dir, exist_ok=True)
+        att_dir = self._ensure_att_dir(conv_key)
         part = os.path.join(att_dir, filename + ".part")
+        prev = self._rx_files.get((conv_key, sender, filename)) or {}
+        self._rx_close_fd(prev, final=True)
         try:
             with open(part, "wb") as f:
                 pass
         except Exception:
             pass
-        prev = self._rx_files.get((conv_key, sender, filename)) or {}
         md5 = prev.get("md5")
         self._rx_files[(conv_key, sender, filename)] = {"mime": mime, "total": int(max(0, total)), "part": part, "chunks": {}, "md5": md5}
         try:
@@ -8128,7 +8459,7 @@ class ChatWindow(QtWidgets.QWidget):
                         pass
                     self._ensure_conv(conv_key)
                     m = self.conv_models.get(conv_key)
-                    av = self.avatar_pixmap if sender == self.username else self.peer_avatars.get(sender)
+                    av = self._av_for_sender(sender)
                     is_self = (sender == self.username)
                     final_size = None
                     try:
@@ -8147,6 +8478,11 @@ class ChatWindow(QtWidgets.QWidget):
             except Exception:
                 return
         if key in getattr(self, "_finalizing_files", set()):
+            # already waiting on missing chunks; the writer calls back here once the
+            # part file reaches its size, so retry right away instead of on a timer
+            fin = d.get("finalize")
+            if fin:
+                fin()
             return
         try:
             self._finalizing_files.add(key)
@@ -8164,12 +8500,15 @@ class ChatWindow(QtWidgets.QWidget):
                     file_sz = 0
                 if not isinstance(chunks, dict) or not chunks:
                     return int(max(0, file_sz))
-                off = 0
+                # resume from the last known frontier; chunks never shrink, so each
+                # offset is walked over once per transfer instead of once per tick
+                off = int(d.get("contig") or 0)
                 while True:
                     ln = chunks.get(off)
                     if not ln or ln <= 0:
                         break
                     off += int(max(0, ln))
+                d["contig"] = off
                 return int(max(0, max(off, file_sz)))
             except Exception:
                 try:
@@ -8193,7 +8532,7 @@ class ChatWindow(QtWidgets.QWidget):
                 pix = QtGui.QPixmap(dst) if mime.startswith("image/") else None
                 self._ensure_conv(conv_key)
                 m = self.conv_models.get(conv_key)
-                av = self.avatar_pixmap if sender == self.username else self.peer_avatars.get(sender)
+                av = self._av_for_sender(sender)
                 is_self = (sender == self.username)
                 final_size = None
                 try:
@@ -8201,7 +8540,8 @@ class ChatWindow(QtWidgets.QWidget):
                 except Exception:
                     final_size = None
                 found_row = -1
-                if m:
+                # file_names answers "is there such a row at all" without walking the chat
+                if m and (sender, filename) in m.file_names:
                     for i, it in enumerate(m.items):
                         if it.get("kind") == "file" and it.get("filename") == filename and it.get("sender") == sender:
                             found_row = i
@@ -8236,11 +8576,7 @@ class ChatWindow(QtWidgets.QWidget):
                     self._finalizing_files.remove(key)
             except Exception:
                 pass
-            try:
-                if key in self._rx_files:
-                    del self._rx_files[key]
-            except Exception:
-                pass
+            self._rx_drop(key)
         def _attempt_finalize():
             partp = d.get("part")
             total = int(d.get("total") or 0)
@@ -8251,33 +8587,31 @@ class ChatWindow(QtWidgets.QWidget):
             except Exception:
                 part_sz = 0
             if partp and os.path.isfile(partp) and (total <= 0 or cur >= total or part_sz >= total):
+                # release the writer fd so the move works everywhere, and close for good: a drain
+                # task still queued must not recreate partp (O_CREAT) once it has been renamed
+                self._rx_close_fd(d, final=True)
                 try:
-                    if os.path.isfile(dst):
-                        try:
-                            os.remove(dst)
-                        except Exception:
-                            pass
-                    try:
-                        shutil.move(partp, dst)
-                    except Exception:
-                        try:
-                            shutil.copyfile(partp, dst)
-                            try:
-                                os.remove(partp)
-                            except Exception:
-                                pass
-                        except Exception:
-                            return False
+                    # part and dst share att_dir, so this is one atomic rename that also
+                    # replaces an older copy of dst
+                    os.replace(partp, dst)
                 except Exception:
+                    # still a .part file: let later chunks and the watchdog retry
+                    with d.setdefault("lock", threading.Lock()):
+                        d.pop("closed", None)
                     return False
                 _do_update_and_cleanup()
                 return True
             return False
+        d["finalize"] = _attempt_finalize
         if not _attempt_finalize():
             try:
-                max_tries = 200  # ~30s with 150ms interval
+                # watchdog only: completion is event-driven from the writer; this just asks the
+                # sender for missing ranges now and then and gives up after ~30s
+                max_tries = 6
                 tries = [0]
                 def _tick():
+                    if key not in self._finalizing_files or self._rx_files.get(key) is not d:
+                        return
                     if _attempt_finalize():
                         return
                     tries[0] += 1
@@ -8285,25 +8619,22 @@ class ChatWindow(QtWidgets.QWidget):
                         cur = _contiguous_prefix_size()
                         md5 = d.get("md5")
                         if md5 and cur > 0:
-                            if conv_key.startswith("dm:"):
-                                peer = sender
+                            kind, rid = self._rx_route(d, conv_key)
+                            if kind == "dm":
                                 try:
-                                    self._send_seq(f"DM {peer} FILE_HAVE {md5} {cur} PARTIAL")
+                                    self._send_seq(f"DM {sender} FILE_HAVE {md5} {cur} PARTIAL")
                                 except Exception:
                                     pass
-                            elif conv_key.startswith("group:"):
+                            elif kind == "group":
                                 try:
-                                    rid = conv_key.split(":",1)[1]
                                     self._send_seq(f"MSG FILE_HAVE {md5} {cur} PARTIAL", rid)
                                 except Exception:
                                     pass
                     except Exception:
                         pass
                     if tries[0] < max_tries:
-                        QtCore.QTimer.singleShot(150, _tick)
-                    else:
-                        pass
-                QtCore.QTimer.singleShot(150, _tick)
+                        QtCore.QTimer.singleShot(self.RX_WATCHDOG_MS, _tick)
+                QtCore.QTimer.singleShot(self.RX_WATCHDOG_MS, _tick)
             except Exception:
                 try:
                     _do_update_and_cleanup()
@@ -8349,124 +8680,109 @@ class ChatWindow(QtWidgets.QWidget):
         dlg.resize(600, 400)
         dlg.exec()
 
-    def _text_pos_from_event(self, index: QtCore.QModelIndex, vp_pos: QtCore.QPoint):
-        r = self.view.visualRect(index)
-        kind = index.data(ChatModel.KindRole)
-        if kind != "msg":
-            return None
-        text = index.data(ChatModel.TextRole) or ""
-        is_self = bool(index.data(ChatModel.SelfRole))
-        fm = self.view.fontMetrics()
-        maxw = int(r.width() * 0.65)
+    BUBBLE_LAYOUT_CACHE_MAX = 256
+
+    def _bubble_layout(self, text: str, maxw: int, extra: int):
+        """Return (doc, text_w, doc_h) for a message bubble, laid out once per text/font/width."""
+        font = self.view.font()
+        key = (text, font.key(), maxw, extra)
+        cache = self._bubble_layout_cache
+        hit = cache.get(key)
+        if hit is not None:
+            cache.move_to_end(key)
+            return hit
         doc = QtGui.QTextDocument()
         opt = QtGui.QTextOption()
         opt.setWrapMode(QtGui.QTextOption.WrapAtWordBoundaryOrAnywhere)
-        doc.setDefaultFont(option.font)
+        doc.setDefaultFont(font)
         doc.setDefaultTextOption(opt)
-        w0 = fm.horizontalAdvance(text)
-        text_w = min(w0 + 6, maxw)
+        w0 = self.view.fontMetrics().horizontalAdvance(text)
+        text_w = min(w0 + extra, maxw)
         doc.setTextWidth(text_w)
         doc.setPlainText(text)
+        hit = (doc, text_w, int(doc.size().height()))
+        cache[key] = hit
+        if len(cache) > self.BUBBLE_LAYOUT_CACHE_MAX:
+            cache.popitem(last=False)
+        return hit
+
+    def _hit_bubble(self, index: QtCore.QModelIndex, vp_pos: QtCore.QPoint):
+        """Return (contains, text_pos) for a viewport point over a message bubble."""
+        if index.data(ChatModel.KindRole) != "msg":
+            return False, None
+        r = self.view.visualRect(index)
+        text = index.data(ChatModel.TextRole) or ""
+        is_self = bool(index.data(ChatModel.SelfRole))
+        maxw = int(r.width() * 0.65)
         pad = 12
-        bubble_w = int(text_w) + pad * 2
-        bubble_h = int(doc.size().height()) + pad * 2
         margin = 10
         avatar_size = 22
         avatar_pad = 8
-        bubble_x = r.right() - bubble_w - margin - avatar_size - avatar_pad if is_self else r.left() + margin + avatar_size + avatar_pad
-        bubble_y = r.top() + 26
-        text_rect = QtCore.QRect(bubble_x + pad, bubble_y + pad, bubble_w - 2*pad, bubble_h - 2*pad)
+
+        def _rect(text_w: int, doc_h: int) -> QtCore.QRect:
+            bubble_w = int(text_w) + pad * 2
+            bubble_x = r.right() - bubble_w - margin - avatar_size - avatar_pad if is_self else r.left() + margin + avatar_size + avatar_pad
+            return QtCore.QRect(bubble_x, r.top() + 26, bubble_w, doc_h + pad * 2)
+
+        # containment (the I-beam hover region) keeps the unpadded text width it always
+        # had; the caret hit-test lays the text out 6px wider, as before
+        _doc, text_w, doc_h = self._bubble_layout(text, maxw, 0)
+        if not _rect(text_w, doc_h).contains(vp_pos):
+            return False, None
+        doc, text_w, doc_h = self._bubble_layout(text, maxw, 6)
+        text_rect = _rect(text_w, doc_h).adjusted(pad, pad, -pad, -pad)
         if not text_rect.contains(vp_pos):
-            return None
+            return True, None
         local = QtCore.QPointF(vp_pos.x() - text_rect.x(), vp_pos.y() - text_rect.y())
         # clamp to content area to ensure hitTest returns a position
         local.setX(max(0.0, min(local.x(), float(text_rect.width() - 1))))
         local.setY(max(0.0, min(local.y(), float(text_rect.height() - 1))))
-        layout = doc.documentLayout()
         try:
-            pos = layout.hitTest(local, QtCore.Qt.FuzzyHit)
+            pos = doc.documentLayout().hitTest(local, QtCore.Qt.FuzzyHit)
             if pos < 0:
                 # fallback to nearest edge
                 if local.x() <= 0.0 and local.y() <= 0.0:
-                    return 0
-                return len(text)
-            return pos
+                    return True, 0
+                return True, len(text)
+            return True, pos
         except Exception:
-            return None
+            return True, None
+
+    def _text_pos_from_event(self, index: QtCore.QModelIndex, vp_pos: QtCore.QPoint):
+        return self._hit_bubble(index, vp_pos)[1]
 
     def _bubble_contains(self, index: QtCore.QModelIndex, vp_pos: QtCore.QPoint) -> bool:
-        r = self.view.visualRect(index)
-        kind = index.data(ChatModel.KindRole)
-        if kind != "msg":
-            return False
-        text = index.data(ChatModel.TextRole) or ""
-        is_self = bool(index.data(ChatModel.SelfRole))
-        fm = self.view.fontMetrics()
-        maxw = int(r.width() * 0.65)
-        doc = QtGui.QTextDocument()
-        opt = QtGui.QTextOption()
-        opt.setWrapMode(QtGui.QTextOption.WrapAtWordBoundaryOrAnywhere)
-        doc.setDefaultFont(self.view.font())
-        doc.setDefaultTextOption(opt)
-        w0 = fm.horizontalAdvance(text)
-        text_w = min(w0, maxw)
-        doc.setTextWidth(text_w)
-        doc.setPlainText(text)
-        pad = 12
-        bubble_w = int(text_w) + pad * 2
-        bubble_h = int(doc.size().height()) + pad * 2
-        margin = 10
-        avatar_size = 22
-        avatar_pad = 8
-        bubble_x = r.right() - bubble_w - margin - avatar_size - avatar_pad if is_self else r.left() + margin + avatar_size + avatar_pad
-        bubble_y = r.top() + 26
-        bubble_rect = QtCore.QRect(bubble_x, bubble_y, bubble_w, bubble_h)
-        return bubble_rect.contains(vp_pos)
+        return self._hit_bubble(index, vp_pos)[0]
+
+    def _stop_receiver(self, rx, threads: list):
+        with contextlib.suppress(Exception):
+            if rx and rx.isRunning():
+                rx.stop()
+                threads.append(rx)
 
     def cleanup(self):
         try:
-            if hasattr(self, 'reconnect_timer'):
-                try:
-                    self.reconnect_timer.stop()
-                except Exception:
-                    pass
-            if hasattr(self, 'hb'):
-                try:
-                    self.hb.stop()
-                except Exception:
-                    pass
-            
+            for name in ("reconnect_timer", "hb"):
+                timer = getattr(self, name, None)
+                if timer is not None:
+                    with contextlib.suppress(Exception):
+                        timer.stop()
+
             threads = []
-            # Stop main receiver
-            if hasattr(self, 'rx') and self.rx:
-                try:
-                    if self.rx.isRunning():
-                        self.rx.stop()
-                        threads.append(self.rx)
-                except Exception:
-                    pass
-            
-            # Stop room receivers
-            if hasattr(self, 'receivers'):
-                for rx in self.receivers.values():
-                    try:
-                        if rx and rx.isRunning():
-                            rx.stop()
-                            threads.append(rx)
-                    except Exception:
-                        pass
-            
+            # main receiver, then one per room
+            self._stop_receiver(getattr(self, "rx", None), threads)
+            for rx in getattr(self, "receivers", {}).values():
+                self._stop_receiver(rx, threads)
+
             # Wait for all threads
             for t in threads:
-                try:
+                with contextlib.suppress(Exception):
                     if t.isRunning():
                         t.wait(100)
                     if t.isRunning():
                         t.terminate()
                         t.wait(50)
-                except Exception:
-                    pass
-            
+
             self._on_app_quit()
         except Exception:
             pass
@@ -8530,6 +8846,11 @@ class ChatWindow(QtWidgets.QWidget):
                 pass
         except Exception:
             pass
+        try:
+            if self.logger:
+                self.logger.close()
+        except Exception:
+            pass
 
 
 def parse_args():
@@ -8587,23 +8908,20 @@ def _ensure_user_config(path: str):
         ddir = os.path.dirname(p)
         os.makedirs(ddir, exist_ok=True)
         defaults = {"host": "127.0.0.1", "port": 34567, "room": "世界", "theme": "flat", "max_upload_mb": 40}
-        if os.path.isfile(p):
-            try:
-                with open(p, "r", encoding="utf-8") as f:
-                    data = json.load(f) or {}
-            except Exception:
+        try:
+            with open(p, "r", encoding="utf-8") as f:
+                data = json.load(f) or {}
+            if not isinstance(data, dict):
                 data = {}
-            changed = False
-            for k, v in defaults.items():
-                if k not in data:
-                    data[k] = v
-                    changed = True
-            if changed:
-                with open(p, "w", encoding="utf-8") as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
-        else:
-            with open(p, "w", encoding="utf-8") as f:
-                json.dump(defaults, f, ensure_ascii=False, indent=2)
+        except Exception:
+            # missing or unreadable: rewritten from defaults below
+            data = None
+        merged = {**defaults, **(data or {})}
+        if merged != data:
+            tmp = p + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(merged, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, p)
     except Exception:
         pass
 
@@ -8655,6 +8973,7 @@ def main():
     prof_list.setMovement(QtWidgets.QListView.Static)
     prof_list.setSpacing(6)
     prof_list.setSelectionMode(QtWidgets.QAbstractItemView.SingleSelection)
+    prof_list.setItemDelegate(ProfileIconDelegate(prof_list))
     listw = QtWidgets.QListWidget()
     listw.setIconSize(QtCore.QSize(64, 64))
     listw.setViewMode(QtWidgets.QListView.IconMode)
@@ -8701,26 +9020,9 @@ def main():
     # load profiles
     profiles = _load_profiles(args.log_dir)
     try:
+        # icons are resolved by ProfileIconDelegate when a row is first painted
         for uname, afn in profiles.items():
-            path = os.path.join(icon_dir, afn) if afn else None
-            if path and os.path.exists(path):
-                it = QtWidgets.QListWidgetItem(QtGui.QIcon(path), uname)
-            else:
-                # fallback letter icon
-                pm = QtGui.QPixmap(48, 48)
-                pm.fill(QtCore.Qt.transparent)
-                p = QtGui.QPainter(pm)
-                p.setRenderHint(QtGui.QPainter.Antialiasing, True)
-                hue = (sum(ord(c) for c in uname) % 360)
-                color = QtGui.QColor.fromHsl(hue, 160, 160)
-                p.setBrush(color)
-                p.setPen(QtCore.Qt.NoPen)
-                p.drawEllipse(0, 0, 48, 48)
-                p.setPen(QtGui.QColor(255, 255, 255))
-                f = p.font(); f.setBold(True); p.setFont(f)
-                p.drawText(QtCore.QRect(0, 0, 48, 48), QtCore.Qt.AlignCenter, uname[:1])
-                p.end()
-                it = QtWidgets.QListWidgetItem(QtGui.QIcon(pm), uname)
+            it = QtWidgets.QListWidgetItem(uname)
             it.setData(QtCore.Qt.UserRole, os.path.join(icon_dir, afn) if afn else None)
             prof_list.addItem(it)
     except Exception:
@@ -8731,9 +9033,11 @@ def main():
     except Exception:
         pass
     try:
-        for fn in sorted(os.listdir(icon_dir)):
-            path = os.path.join(icon_dir, fn)
-            if os.path.isfile(path) and fn.lower().endswith((".png", ".jpg", ".jpeg")):
+        with os.scandir(icon_dir) as entries:
+            icon_entries = sorted(entries, key=lambda e: e.name)
+        for entry in icon_entries:
+            path = entry.path
+            if entry.name.lower().endswith((".png", ".jpg", ".jpeg")) and entry.is_file():
                 it = QtWidgets.QListWidgetItem(QtGui.QIcon(path), "")
                 it.setData(QtCore.Qt.UserRole, path)
                 listw.addItem(it)
@@ -8860,26 +9164,57 @@ def main():
     win.cleanup()
     return ret
 
+# profiles.json path -> (mtime_ns, parsed dict); a stat decides whether the copy is current
+_PROFILES_CACHE = {}
+
+
+def _profiles_json(base_dir: str):
+    os.makedirs(base_dir, exist_ok=True)
+    p = os.path.join(base_dir, "profiles.json")
+    try:
+        mtime = os.stat(p).st_mtime_ns
+    except OSError:
+        _PROFILES_CACHE.pop(p, None)
+        return p, {}
+    cached = _PROFILES_CACHE.get(p)
+    if cached is not None and cached[0] == mtime:
+        return p, cached[1]
+    try:
+        with open(p, "r", encoding="utf-8") as f:
+            d = json.load(f) or {}
+    except Exception:
+        d = {}
+    if not isinstance(d, dict):
+        d = {}
+    _PROFILES_CACHE[p] = (mtime, d)
+    return p, d
+
+
+def _write_profiles_json(p: str, d: dict):
+    tmp = p + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(d, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, p)
+    try:
+        _PROFILES_CACHE[p] = (os.stat(p).st_mtime_ns, d)
+    except OSError:
+        _PROFILES_CACHE.pop(p, None)
+
+
 def _load_profiles(base_dir: str):
     try:
-        os.makedirs(base_dir, exist_ok=True)
-        p = os.path.join(base_dir, "profiles.json")
-        data = {}
-        if os.path.exists(p):
-            with open(p, "r", encoding="utf-8") as f:
-                try:
-                    data = json.load(f) or {}
-                except Exception:
-                    data = {}
+        _, data = _profiles_json(base_dir)
+        # callers get their own copy; the fallback entries below are not persisted
+        data = dict(data)
         # fallback: scan subdirectories as usernames
         try:
-            for entry in os.listdir(base_dir):
-                d = os.path.join(base_dir, entry)
-                if os.path.isdir(d) and entry not in data:
-                    if entry == "attachments":
+            with os.scandir(base_dir) as entries:
+                for entry in entries:
+                    name = entry.name
+                    if name in data or name == "attachments" or not entry.is_dir():
                         continue
-                    if os.path.isfile(os.path.join(d, "local.db")):
-                        data[entry] = ""
+                    if os.path.isfile(os.path.join(entry.path, "local.db")):
+                        data[name] = ""
         except Exception:
             pass
         return data
@@ -8888,18 +9223,14 @@ def _load_profiles(base_dir: str):
 
 def _save_profile(base_dir: str, username: str, avatar_filename: Optional[str]):
     try:
-        os.makedirs(base_dir, exist_ok=True)
-        p = os.path.join(base_dir, "profiles.json")
-        d = {}
-        if os.path.exists(p):
-            with open(p, "r", encoding="utf-8") as f:
-                try:
-                    d = json.load(f)
-                except Exception:
-                    d = {}
-        d[username] = avatar_filename or ""
-        with open(p, "w", encoding="utf-8") as f:
-            json.dump(d, f, ensure_ascii=False, indent=2)
+        p, d = _profiles_json(base_dir)
+        value = avatar_filename or ""
+        if d.get(username) == value:
+            # avatar refreshes usually re-save the same name; nothing to write
+            return
+        d = dict(d)
+        d[username] = value
+        _write_profiles_json(p, d)
     except Exception:
         pass
 def _check_username_available(host: str, port: int, room: str, username: str) -> bool:
@@ -8951,19 +9282,11 @@ def _check_username_available(host: str, port: int, room: str, username: str) ->
 
 def _delete_profile(base_dir: str, username: str):
     try:
-        os.makedirs(base_dir, exist_ok=True)
-        p = os.path.join(base_dir, "profiles.json")
-        d = {}
-        if os.path.exists(p):
-            with open(p, "r", encoding="utf-8") as f:
-                try:
-                    d = json.load(f)
-                except Exception:
-                    d = {}
+        p, d = _profiles_json(base_dir)
         if username in d:
+            d = dict(d)
             del d[username]
-            with open(p, "w", encoding="utf-8") as f:
-                json.dump(d, f, ensure_ascii=False, indent=2)
+            _write_profiles_json(p, d)
         
         # Also delete the user's directory if it exists
         user_dir = os.path.join(base_dir, username)